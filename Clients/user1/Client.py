@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
-import os, shutil
+import os, shutil, random, secrets
 import socket
+import select
+import tempfile
+import stat
 import json
 import time
 from protocols import *
@@ -9,8 +12,30 @@ from datetime import datetime
 
 NAMESERVER = ("129.74.152.141", 47697)
 UPDATE_INTERVAL = 60
+# seconds between heartbeats of an online client, which also renew its presence
+# watches; well under the name server's STALE_TIMEOUT and WATCH_TIMEOUT of 120
+HEARTBEAT_INTERVAL = 30
 ACK_TIMEOUT = 5
 MSG_SIZE = 1024
+# seconds to wait on the name server, which may be relaying a friend request
+NS_TIMEOUT = 30
+# attempts at a name server request before giving up
+MAX_RETRIES = 5
+# seconds to wait for UDP lookups before asking over TCP, usernames per lookup_many
+# datagram, and most datagrams per shard before the rest go in one TCP request
+LOOKUP_TIMEOUT = 0.5
+LOOKUP_BATCH = 8
+LOOKUP_DATAGRAMS = 4
+# seconds a username the name server did not know is answered as unknown
+# without asking again, and most such usernames remembered
+NEGATIVE_TTL = 10
+NEGATIVE_MAX = 1000
+# directory of the Unix sockets clients open, named after their address, so that a
+# peer on this host is reached without the loopback; private to the user (see private_dir)
+if os.environ.get('XDG_RUNTIME_DIR'):
+    LOCAL_DIR = os.path.join(os.environ['XDG_RUNTIME_DIR'], 'p2p-chat')
+else:
+    LOCAL_DIR = os.path.join(tempfile.gettempdir(), 'p2p-chat-{}'.format(os.getuid() if hasattr(os, 'getuid') else 'user'))
 
 DEFAULT = {}
 
@@ -90,10 +115,62 @@ def receive_response(conn):
 
 
 
+# Path of the Unix socket of the given kind, 'udp' or 'tcp', that a client
+# at (host, port) opens in LOCAL_DIR
+def local_socket(host, port, kind):
+    return os.path.join(LOCAL_DIR, "{}-{}.{}".format(host, port, kind))
+
+# LOCAL_DIR if it is a directory of ours that no other user can enter, else None;
+# in any other, someone else could put their sockets in our peers' place
+def private_dir():
+    if not hasattr(os, 'getuid'):
+        return None
+    try:
+        info = os.lstat(LOCAL_DIR)
+    except OSError:
+        return None
+    if stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and stat.S_IMODE(info.st_mode) == 0o700:
+        return LOCAL_DIR
+    return None
+
+# Path of the Unix socket of the given kind of a peer at (host, port) on this
+# host, None if it has none or the socket is not ours
+def local_peer(host, port, kind):
+    if not private_dir():
+        return None
+    path = local_socket(host, port, kind)
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return None
+    return path if stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid() else None
+
+# Open a Unix socket of sock_type at the path of the client at (host, port), replacing
+# a stale one; None where there are no Unix sockets
+def bind_local(host, port, kind, sock_type):
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    try:
+        os.makedirs(LOCAL_DIR, mode=0o700, exist_ok=True)
+    except OSError:
+        return None
+    if not private_dir():
+        print("Warning: {} is not a directory only you can access, not opening Unix sockets".format(LOCAL_DIR))
+        return None
+    path = local_socket(host, port, kind)
+    sock = socket.socket(socket.AF_UNIX, sock_type)
+    try:
+        if os.path.exists(path):
+            os.unlink(path)
+        sock.bind(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
 # Send UDP
+# to a peer on this host over its Unix socket if it has one (Linux only)
 def send_udp(topic, from_host, from_port, to_host, to_port, content=None, name = None, recv=True):
-    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_sock.settimeout(10)
     message = {
             'senderHost': from_host,
             'senderPort': from_port,
@@ -104,7 +181,20 @@ def send_udp(topic, from_host, from_port, to_host, to_port, content=None, name =
     if name:
         message['senderName'] = name
     message = json.dumps(message).encode()
-    udp_sock.sendto(message, (to_host, to_port))
+    udp_sock = None
+    path = local_peer(to_host, to_port, 'udp')
+    if path:
+        udp_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            udp_sock.bind('')
+            udp_sock.sendto(message, path)
+        except OSError:
+            udp_sock.close()
+            udp_sock = None
+    if not udp_sock:
+        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_sock.sendto(message, (to_host, to_port))
+    udp_sock.settimeout(10)
     if recv:
         try:
             response, _ = udp_sock.recvfrom(MSG_SIZE)
@@ -123,8 +213,12 @@ def send_udp(topic, from_host, from_port, to_host, to_port, content=None, name =
 # Client class
 # Currently, only allow one connection at a time
 class P2PClient:
-    def __init__(self, username, host, port, nameserver=NAMESERVER):
-        # Name server host and port
+    def __init__(self, username, host, port, nameserver=NAMESERVER, ring=None, udp_lookups=True, bloom=False,
+                 local=True):
+        # Name server host and port, or 'unix:/path' of its Unix socket on this host
+        # ring lists the shard addresses; without it the client asks the name server
+        # udp_lookups sends lookups as datagrams first, bloom skips lookups of names not in
+        # the name servers' Bloom filters, local talks to peers on this host over Unix sockets
         self.username = username
         self.host = host
         self.port = port
@@ -132,11 +226,27 @@ class P2PClient:
         self.chat_history = load_chat_history(username)
         self.online = False
         self.nameserver = nameserver # (host, port)
-        self.nameserverconn = False
+        self.nameserverconns = {} # {(host, port) or 'unix:/path': socket}, long-lived, reconnected on failure
+        self.request_id = 0
+        self.ring = Ring(ring) if ring else None
+        self.ring_fetched = bool(ring)
+        self.replicas = {} # {name server address: (fetched at, [replica addresses])}
+        self.watching = {} # {name server address: set of usernames whose presence it pushes to us}
+        self.presence = False # whether friends' presence is watched, see watch_friends
+        # sent with our watches and echoed in every push, a push without it is forged
+        self.watch_token = secrets.token_hex(16)
+        self.udp_lookups = udp_lookups
+        self.lookupsock = None # UDP socket for lookups, opened on the first one
+        self.udp_silent = {} # {name server address: time until which it is not asked over UDP}
+        self.unknown = {} # {username: time until which it is taken as not registered}
+        self.use_bloom = bloom
+        self.blooms = {} # {name server address: (time until refresh, BloomFilter or None, its version)}
         self.friendconn = False
         self.udpsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udpsock.bind((self.host, self.port))
         self.udpsock.settimeout(5.0)
+        self.local = local
+        self.localsock = bind_local(self.host, self.port, 'udp', socket.SOCK_DGRAM) if local else None
         self.chat_history = {}
         self.posts = {}     # {post_id : post_path} mapping
         self.post_cnt = 0   # monotonically increasing identifier for new post
@@ -147,8 +257,13 @@ class P2PClient:
         save_friends(self.username, self.friends)
         save_groups(self.username, self.groups)
         self.udpsock.close()
-        if not isinstance(self.nameserverconn, bool):
-           self.nameserverconn.close()
+        if self.localsock:
+            os.unlink(self.localsock.getsockname())
+            self.localsock.close()
+        if self.lookupsock:
+            self.lookupsock.close()
+        for conn in self.nameserverconns.values():
+           conn.close()
         if not isinstance(self.friendconn, bool):
            self.friendconn.close()
         
@@ -179,113 +294,411 @@ class P2PClient:
 
 
     ### Interactions with Name Server ###
-    # Send a message to the name server
+    # Send a message to a name server over its long-lived connection
     # Edge case: If send fails, sleep for a while
     # and then close the socket, reconnect, and send again
-    def _send_response_to_server(self, message, length):
+    def _send_response_to_server(self, message, length, address=None):
+        address = address or self.nameserver
         retry_counter = 0
         while True:
             try:
-                self.connect_to_name_server()
-                self.nameserverconn.send(length + message)
+                conn = self.nameserverconns.get(address) or self.connect_to_name_server(address)
+                conn.sendall(length + message)
                 break
             except:
                 print("Send error: cannot send message. Retry in {} seconds".format(2**retry_counter))
                 time.sleep(2**retry_counter)
-                self.nameserverconn.close()
-                self.connect_to_name_server()
+                self.close_name_server(address)
                 retry_counter += 1
                 continue
 
-    def connect_to_name_server(self):
-        # Implement connection to the name server
-        self.nameserverconn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def connect_to_name_server(self, address=None):
+        # Implement connection to the name server (or to one shard of it)
+        address = address or self.nameserver
         retry_counter = 0
-        success = False
+        path = unix_path(address)
         while True:
+            conn = socket.socket(socket.AF_UNIX if path else socket.AF_INET, socket.SOCK_STREAM)
             try:
-                host, port = self.nameserver
-                self.nameserverconn.connect((host, port))
-                success = True
+                if path:
+                    conn.connect(path)
+                else:
+                    host, port = address
+                    conn.connect((host, port))
+                break
             except:
+                conn.close()
                 print("Connection error: cannot connect to nameserver. Retry in {} seconds".format(2**retry_counter))
                 time.sleep(2**retry_counter)
                 retry_counter += 1
                 continue
-            if success:
+        # pipelined requests are small, do not hold them back waiting for acks
+        if not path:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.settimeout(NS_TIMEOUT)
+        self.nameserverconns[address] = conn
+        return conn
+
+    def close_name_server(self, address=None):
+        # Drop a name server connection, the next request reconnects
+        conn = self.nameserverconns.pop(address or self.nameserver, None)
+        if conn:
+            conn.close()
+
+    def fetch_ring(self):
+        # Ask the name server for its shard layout; unsharded servers have none
+        self.ring_fetched = True
+        response = self._request_many([NSPackage('ring', self.username)], [self.nameserver])[0]
+        if response and response['status'] == 'ok':
+            self.ring = Ring.from_dict(response['ring'])
+
+    def _route(self, username):
+        # Address of the name server holding username
+        if not self.ring_fetched:
+            self.fetch_ring()
+        if self.ring:
+            return self.ring.address_of(username)
+        return self.nameserver
+
+    def _exchange(self, address, pending):
+        # Pipeline the pending {id: request} to one name server, returns {id: response}
+        # Edge case: If the connection breaks, reconnect and resend the unanswered requests
+        responses = {}
+        retry_counter = 0
+        while pending:
+            for request in pending.values():
+                message, length = self._process_response(request)
+                self._send_response_to_server(message, length, address)
+            while pending:
+                data = receive_response(self.nameserverconns[address])
+                if not data:
+                    break
+                response = json.loads(data)
+                # servers that predate request ids answer in order
+                request_id = response.pop('id', next(iter(pending)))
+                if pending.pop(request_id, None) is not None:
+                    responses[request_id] = response
+            if not pending:
                 break
-    
+            if retry_counter > MAX_RETRIES:
+                print("Receive error: no response from nameserver.")
+                break
+            # the first retry reconnects right away, the server may just have closed an idle connection
+            if retry_counter:
+                print("Receive error: cannot receive message from nameserver. Retry in {} seconds".format(2**retry_counter))
+                time.sleep(2**retry_counter)
+            self.close_name_server(address)
+            retry_counter += 1
+        return responses
+
+    def _request_many(self, packages, addresses=None, rerouted=False, attempt=0):
+        # Pipeline requests to the shards owning their usernames, or to addresses,
+        # returns the responses in order, None for one that never came
+        if addresses is None:
+            addresses = [self._route(package.to_dict()['username']) for package in packages]
+        batches = {}
+        order = []
+        for package, address in zip(packages, addresses):
+            self.request_id += 1
+            batches.setdefault(address_key(address), {})[self.request_id] = {**package.to_dict(), 'id': self.request_id}
+            order.append(self.request_id)
+        responses = {}
+        for address, pending in batches.items():
+            responses.update(self._exchange(address, pending))
+        responses = [responses.get(request_id) for request_id in order]
+        moved = [i for i, response in enumerate(responses) if response and response['status'] == 'moved']
+        if moved and not rerouted:
+            # the shard layout changed, refresh it and resend to the new owners
+            self.fetch_ring()
+            retried = self._request_many([packages[i] for i in moved], rerouted=True)
+            for i, response in zip(moved, retried):
+                responses[i] = response
+        limited = [i for i, response in enumerate(responses) if response and response['status'] == 'retry']
+        if limited and attempt < MAX_RETRIES:
+            # the name server is rate limiting us, come back when it says to
+            time.sleep(max(responses[i]['after'] for i in limited))
+            retried = self._request_many([packages[i] for i in limited], [addresses[i] for i in limited],
+                                         rerouted, attempt + 1)
+            for i, response in zip(limited, retried):
+                responses[i] = response
+        return responses
+
+    def _request(self, package):
+        # Send one request to the name server and return its response, or None
+        return self._request_many([package])[0]
+
+    def _replica_of(self, address):
+        # A read replica of the name server at address, or None to read from it directly,
+        # as from one on this host
+        if unix_path(address):
+            return None
+        fetched, replicas = self.replicas.get(address, (0, []))
+        if time.time() - fetched > UPDATE_INTERVAL:
+            response = self._request_many([NSPackage('replicas', self.username)], [address])[0]
+            replicas = []
+            if response and response['status'] == 'ok':
+                replicas = [tuple(replica) for replica in response['replicas']]
+            self.replicas[address] = (time.time(), replicas)
+        return random.choice(replicas) if replicas else None
+
+    def _ask_replica(self, address, packages):
+        # Pipeline requests to a read replica, returns their responses in order, all None
+        # if it cannot be reached
+        for attempt in range(2):
+            try:
+                conn = self.nameserverconns.get(address)
+                if not conn:
+                    conn = socket.create_connection(address, timeout=ACK_TIMEOUT)
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.nameserverconns[address] = conn
+                order = []
+                for package in packages:
+                    self.request_id += 1
+                    order.append(self.request_id)
+                    message, length = self._process_response({**package.to_dict(), 'id': self.request_id})
+                    conn.sendall(length + message)
+                responses = {}
+                while len(responses) < len(order):
+                    data = receive_response(conn)
+                    if not data:
+                        raise OSError("replica closed the connection")
+                    response = json.loads(data)
+                    responses[response.pop('id', None)] = response
+                return [responses.get(request_id) for request_id in order]
+            except OSError:
+                self.close_name_server(address)
+        return [None] * len(packages)
+
+    def _read_many(self, packages, addresses):
+        # Send read-only requests to a replica of the name server at their address;
+        # what it does not answer goes to the name server itself
+        responses = [None] * len(packages)
+        batches = {}
+        for i, address in enumerate(addresses):
+            replica = self._replica_of(address_key(address))
+            if replica:
+                batches.setdefault(replica, []).append(i)
+        for replica, indices in batches.items():
+            answers = self._ask_replica(replica, [packages[i] for i in indices])
+            if all(answer is None for answer in answers):
+                # the replica is gone, stop reading from it
+                for i in indices:
+                    fetched, replicas = self.replicas[address_key(addresses[i])]
+                    if replica in replicas:
+                        replicas.remove(replica)
+            for i, answer in zip(indices, answers):
+                if answer and answer['status'] not in ('stale', 'readonly', 'retry'):
+                    responses[i] = answer
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            answers = self._request_many([packages[i] for i in missing], [addresses[i] for i in missing])
+            for i, answer in zip(missing, answers):
+                responses[i] = answer
+        return responses
+
+    def _read_udp(self, packages, addresses):
+        # Send read-only requests as datagrams to a replica or the name server at their
+        # address, returns their responses in order, None for one not answered in time
+        responses = [None] * len(packages)
+        if not self.udp_lookups:
+            return responses
+        if not self.lookupsock:
+            self.lookupsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        pending = {} # {request id: (index, server address, its resolved address)}
+        for i, (package, address) in enumerate(zip(packages, addresses)):
+            target = self._replica_of(address_key(address)) or address_key(address)
+            if unix_path(target) or self.udp_silent.get(target, 0) > time.time():
+                continue
+            request_id = secrets.randbits(63)
+            message = json.dumps({**package.to_dict(), 'id': request_id}).encode()
+            if len(message) > MAX_DATAGRAM or request_id in pending:
+                continue
+            try:
+                resolved = (socket.gethostbyname(target[0]), target[1])
+                self.lookupsock.sendto(message, resolved)
+            except OSError:
+                continue
+            pending[request_id] = (i, target, resolved)
+        asked = {target for _, target, _ in pending.values()}
+        answered = set()
+        deadline = time.time() + LOOKUP_TIMEOUT
+        while pending and time.time() < deadline:
+            self.lookupsock.settimeout(deadline - time.time())
+            try:
+                data, sender = self.lookupsock.recvfrom(MAX_DATAGRAM)
+                response = json.loads(data)
+            except socket.timeout:
+                break
+            except (OSError, ValueError):
+                continue
+            request_id = response.pop('id', None) if isinstance(response, dict) else None
+            # replies that come after their request gave up, or from elsewhere, are ignored
+            if not isinstance(request_id, int) or pending.get(request_id, (None, None, None))[2] != sender[:2]:
+                continue
+            i, target, _ = pending.pop(request_id)
+            answered.add(target)
+            if response.get('status') not in (None, 'tcp', 'stale', 'readonly', 'retry'):
+                responses[i] = response
+        for target in asked - answered:
+            self.udp_silent[target] = time.time() + UPDATE_INTERVAL
+        return responses
+
+    def _read(self, packages, addresses):
+        # Read-only requests over UDP where they can be, the rest over TCP
+        responses = self._read_udp(packages, addresses)
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            answers = self._read_many([packages[i] for i in missing], [addresses[i] for i in missing])
+            for i, answer in zip(missing, answers):
+                responses[i] = answer
+        return responses
+
+    def _by_shard(self, usernames):
+        # Group usernames by the name server holding them, {address: [username]}
+        shards = {}
+        for name in usernames:
+            shards.setdefault(self._route(name), []).append(name)
+        return shards
+
+    def _lookup_many(self, usernames):
+        # Look up users, returns {username: info}: LOOKUP_BATCH users a datagram
+        # over UDP, the users left unanswered in one lookup_many per shard over TCP
+        users = {}
+        missing = self._by_shard(usernames)
+        if self.udp_lookups:
+            packages = []
+            addresses = []
+            for address, names in missing.items():
+                if len(names) > LOOKUP_BATCH * LOOKUP_DATAGRAMS:
+                    continue
+                for start in range(0, len(names), LOOKUP_BATCH):
+                    packages.append(NSPackage('lookup_many', self.username, usernames=names[start:start + LOOKUP_BATCH]))
+                    addresses.append(address)
+            missing = {address: names for address, names in missing.items() if address not in addresses}
+            for package, address, response in zip(packages, addresses, self._read_udp(packages, addresses)):
+                if response and response['status'] == 'ok':
+                    users.update(response['users'])
+                else:
+                    missing.setdefault(address, []).extend(package.to_dict()['usernames'])
+        packages = [NSPackage('lookup_many', self.username, usernames=names) for names in missing.values()]
+        for response in self._read_many(packages, list(missing)):
+            if not response or response['status'] != 'ok':
+                print("Error: cannot lookup on every nameserver")
+                continue
+            users.update(response['users'])
+        return users
+
     def update_friend_info(self):
         # Implement updating friend info from the name server
-        retry_counter = 0
-        for friend in self.friends:
-            package = NSPackage('lookup', friend)
-            message, length = self._process_response(package.to_dict())
-            self._send_response_to_server(message, length)
-            data = receive_response(self.nameserverconn)
-            while not data:
-                time.sleep(2**retry_counter)
-                print("Receive error: cannot receive message from nameserver on update_friend. Retry in {} seconds".format(2**retry_counter))
-                retry_counter += 1
-                self._send_response_to_server(message, length)
-                data = receive_response(self.nameserverconn)
-            friend_info = json.loads(data)
+        # all friends are looked up in a single lookup_many round trip per shard
+        if not self.friends:
+            return
+        self._update_friends(self._lookup_many(list(self.friends)))
+
+    def _update_friends(self, users):
+        # Store looked up or pushed information of friends
+        for friend, friend_info in users.items():
+            if friend not in self.friends:
+                continue
+            if isinstance(friend_info["address"], str):
+                host, port = friend_info["address"].split()
+                friend_info["address"] = (host, int(port))
+            else:
+                friend_info["address"] = tuple(friend_info["address"])
             self.friends[friend] = friend_info # {'address': addr, 'status': status, 'last_update': last_update}
-    
+
+    def watch_friends(self, usernames=None):
+        # Subscribe to presence changes of friends (all of them by default), pushed to
+        # our UDP port, see handle_udp
+        self.presence = True
+        usernames = list(self.friends) if usernames is None else usernames
+        shards = self._by_shard(usernames)
+        packages = [NSPackage('watch', self.username, address=(self.host, self.port), usernames=names,
+                              token=self.watch_token) for names in shards.values()]
+        for (address, names), response in zip(shards.items(), self._request_many(packages, list(shards))):
+            if not response or response['status'] != 'ok':
+                print("Error: cannot watch friends on every nameserver")
+                continue
+            self.watching.setdefault(address, set()).update(names)
+            self._update_friends(response['users'])
+
     def go_online(self):
         # Implement going online and updating the name server
-        package = NSPackage('register', self.username, (self.host, self.port), 'online')
-        message, length = self._process_response(package.to_dict())
-        self._send_response_to_server(message, length)
-        data = receive_response(self.nameserverconn)
-        retry_counter = 0
-        while not data:
-            print("Receive error: cannot receive message from nameserver on go_online. Retry in {} seconds".format(2**retry_counter))
-            time.sleep(2**retry_counter)
-            self._send_response_to_server(message, length)
-            data = receive_response(self.nameserverconn)
-        response = json.loads(data)
-        if response['status'] == 'ok':
+        # once online, a heartbeat keeps us online and renews the watches
+        register = NSPackage('register', self.username, (self.host, self.port), 'online')
+        package = NSPackage('heartbeat', self.username, (self.host, self.port)) if self.online else register
+        watched = list(self.watching)
+        renewals = [NSPackage('watch', self.username, address=(self.host, self.port), token=self.watch_token)
+                    for _ in watched]
+        responses = self._request_many([package] + renewals, [self._route(self.username)] + watched)
+        for address, renewal in zip(watched, responses[1:]):
+            if not renewal or renewal['status'] != 'ok':
+                # the watch expired on that name server, subscribe again
+                self.watch_friends(list(self.watching.pop(address)))
+        response = responses[0]
+        if package is not register and (not response or response['status'] != 'ok'):
+            # the name server has us offline or elsewhere, register again
+            response = self._request(register)
+        if response and response['status'] == 'ok':
             self.online = True
             return True
         else:
             return False
-    
+
     def go_offline(self):
         # Implement going offline and updating the name server
         package = NSPackage('register', self.username, (self.host, self.port), 'offline')
-        message, length = self._process_response(package.to_dict())
-        self._send_response_to_server(message, length)
-        data = receive_response(self.nameserverconn)
-        retry_counter = 0
-        while not data:
-            print("Receive error: cannot receive message from nameserver on go_offline. Retry in {} seconds".format(2**retry_counter))
-            time.sleep(2**retry_counter)
-            self._send_response_to_server(message, length)
-            data = receive_response(self.nameserverconn)
-        response = json.loads(data)
-        if response['status'] == 'ok':
+        response = self._request(package)
+        if response and response['status'] == 'ok':
             self.online = False
             print("Successfully go offline")
         else:
             print("Error: cannot go offline")
 
+    def _may_exist(self, username):
+        # False if username is known not to be registered without asking the name server,
+        # from a recent lookup or its name server's Bloom filter
+        if self.unknown.get(username, 0) > time.time():
+            return False
+        if not self.use_bloom:
+            return True
+        address = self._route(username)
+        expires, bloom, version = self.blooms.get(address, (0, None, None))
+        if expires < time.time():
+            response = self._request_many([NSPackage('bloom', self.username, version=version)], [address])[0]
+            if not response or response['status'] not in ('ok', 'not modified'):
+                bloom = version = None
+            elif response['status'] == 'ok':
+                if 'bloom' in response:
+                    bloom = BloomFilter.from_dict(response['bloom'])
+                for name in response['added']:
+                    bloom.add(name)
+                version = response['version']
+            self.blooms[address] = (time.time() + (UPDATE_INTERVAL if bloom else NEGATIVE_TTL), bloom, version)
+        return bloom is None or bloom.might_contain(username)
+
+    def _not_found(self, username):
+        # Remember that username is not registered, for NEGATIVE_TTL seconds
+        if len(self.unknown) >= NEGATIVE_MAX:
+            now = time.time()
+            self.unknown = {name: expires for name, expires in self.unknown.items() if expires > now}
+        self.unknown[username] = time.time() + NEGATIVE_TTL
+
     def lookup(self, username):
         # Implement looking up a peer from name server
+        # names known not to be registered are answered at once
+        if not self._may_exist(username):
+            return None
         package = NSPackage('lookup', username)
-        message, length = self._process_response(package.to_dict())
-        self._send_response_to_server(message, length)
-        data = receive_response(self.nameserverconn)
-        retry_counter = 0
-        while not data:
-            print("Receive error: cannot receive message from nameserver on lookup. Retry in {} seconds".format(2**retry_counter))
-            time.sleep(2**retry_counter)
-            self._send_response_to_server(message, length)
-            data = receive_response(self.nameserverconn)
-        response = json.loads(data)
+        response = self._read([package], [self._route(username)])[0]
         if response:
             # print("Successfully lookup {}".format(username))
             if response["status"] == "error":
+                self._not_found(username)
+                return None
+            if "address" not in response:
+                # still rate limited or moved after the retries, the user may well exist
+                print("Error: cannot lookup {} ({})".format(username, response["status"]))
                 return None
             if isinstance(response["address"], str):
                     host, port = response["address"].split()
@@ -298,6 +711,47 @@ class P2PClient:
             print("Error: cannot lookup")
             return None
 
+    def _page(self, op, key, prefix, limit, after, read):
+        # One page of a paged listing from every shard, merged in name order;
+        # returns ({name: info}, cursor), the cursor is None on the last page
+        if not self.ring_fetched:
+            self.fetch_ring()
+        addresses = list(self.ring.shards) if self.ring else [self.nameserver]
+        packages = [NSPackage(op, self.username, prefix=prefix, limit=limit, after=after) for _ in addresses]
+        responses = read(packages, addresses)
+        found = {}
+        more = False
+        for response in responses:
+            if not response or response['status'] != 'ok':
+                print("Error: cannot reach every nameserver")
+                continue
+            found.update(response[key])
+            more = more or response['next'] is not None
+        names = sorted(found)
+        if len(names) > limit:
+            names, more = names[:limit], True
+        return {name: found[name] for name in names}, (names[-1] if more and names else None)
+
+    def search(self, prefix, limit=20, after=None):
+        # Find users whose names start with prefix, at most limit at a time; returns
+        # ({username: info}, cursor), the cursor to pass as after, None on the last page
+        return self._page('search', 'users', prefix, limit, after, self._read_many)
+
+    def list_groups(self, prefix='', limit=20, after=None):
+        # Public groups whose names start with prefix, paged like search;
+        # a group's info has its member count if its leader reported one
+        return self._page('list_groups', 'groups', prefix, limit, after, self._request_many)
+
+    def report_members(self, group_name):
+        # As leader of a public group, tell the name server how many members it has
+        group = self.groups.get(group_name)
+        if not group or not group.get("is_public") or group["leader"] != self.username:
+            return
+        package = NSPackage('group_info', group_name, members=len(group["members"]))
+        response = self._request(package)
+        if not response or response['status'] != 'ok':
+            print("Error: cannot report members of group [{}] to nameserver.".format(group_name))
+
     ### Interactions with Friends ###
 
     # receive a message (data) from a friend (conn)
@@ -309,8 +763,6 @@ class P2PClient:
             print("Error: this user is offline")
             return False
         addr = self.friends[username]['address']
-        self.friendconn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.friendconn.settimeout(5.0)
         retry_counter = 0
         success = False
         # send connection request udp packet
@@ -335,7 +787,7 @@ class P2PClient:
         while True:
             try:
                 host, port = addr
-                self.friendconn.connect((host, port))
+                self.friendconn = self._connect_peer(host, port)
                 success = True
             except:
                 print("Connection error: cannot connect to friend. Retry in {} seconds".format(2**retry_counter))
@@ -347,37 +799,70 @@ class P2PClient:
                 break
         return self.friendconn
 
+    # open a stream connection to a peer's chat server: over its Unix socket
+    # if it is on this host and has one, else over TCP
+    def _connect_peer(self, host, port):
+        path = local_peer(host, port, 'tcp')
+        if path:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.settimeout(5.0)
+            try:
+                conn.connect(path)
+                return conn
+            except OSError:
+                conn.close()
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.settimeout(5.0)
+        try:
+            conn.connect((host, port))
+        except:
+            conn.close()
+            raise
+        return conn
+
     # handle udp packet request
     def handle_udp(self):
-        # receive udp packet
+        # receive udp packet, or a datagram from a peer on this host
+        sockets = [self.udpsock, self.localsock] if self.localsock else [self.udpsock]
+        ready, _, _ = select.select(sockets, [], [], self.udpsock.gettimeout())
+        if not ready: #timeout
+            return False
+        sock = ready[0]
         try:
-            message, addr = self.udpsock.recvfrom(MSG_SIZE)
-        except: #timeout
+            message, sender = sock.recvfrom(MSG_SIZE)
+        except:
             return False
         message = json.loads(message.decode())
+        # answers go back to the sending socket; a peer on this host is known by
+        # the address it sent, as the name of its socket means nothing elsewhere
+        addr = sender if sock is self.udpsock else (message["senderHost"], message["senderPort"])
         if message["topic"] == "connect":
             print("Received connection request from {}".format(message["senderName"]) + " with content {}".format(message["content"]))
             decision = input("Do you accept the request? (yes/no): ")
             if decision.lower() == 'yes':
-                self.udpsock.sendto(json.dumps({'status': 'success'}).encode(), addr)
+                sock.sendto(json.dumps({'status': 'success'}).encode(), sender)
                 self.start_server(message["senderName"])
                 #return True
             else:
-                self.udpsock.sendto(json.dumps({'status': 'reject'}).encode(), addr)
+                sock.sendto(json.dumps({'status': 'reject'}).encode(), sender)
                 #return False
         elif message["topic"] == 'add friend':
             friendname = message["content"]["username"]
             print(f"Received friend request from {friendname}")
             decision = input("Do you accept the request? (yes/no): ")
+            # the name server matches our answer to its request by the relay id
+            relay = message.get("relay")
             if decision.lower() == 'yes':
-                self.udpsock.sendto(json.dumps({'status': 'success'}).encode(), addr)
+                sock.sendto(json.dumps({'status': 'success', 'relay': relay}).encode(), sender)
                 # add friend
                 content = message["content"]
                 fhost, fport = content["host"], content["port"]
                 self.friends[content["username"]] = {'address': (fhost, fport), 'status': 'online', 'last_update': time.time()}
+                if self.presence:
+                    self.watch_friends([content["username"]])
                 #return True
             else:
-                self.udpsock.sendto(json.dumps({'status': 'reject'}).encode(), addr)
+                sock.sendto(json.dumps({'status': 'reject', 'relay': relay}).encode(), sender)
                 #return False
         elif message["topic"] == "join group":
             user_name, group_name = message["content"].split()
@@ -386,30 +871,31 @@ class P2PClient:
             if decision.lower() == 'yes':
                 self.groups[group_name]["members"].append((user_name, addr))
                 save_groups(self.username, self.groups)
-                self.udpsock.sendto(json.dumps({'status': 'success', "leader": self.username, "members":self.groups[group_name]["members"]}).encode(), addr)
+                sock.sendto(json.dumps({'status': 'success', "leader": self.username, "members":self.groups[group_name]["members"]}).encode(), sender)
+                self.report_members(group_name)
             else:
-                self.udpsock.sendto(json.dumps({'status': 'reject'}).encode(), addr)
+                sock.sendto(json.dumps({'status': 'reject'}).encode(), sender)
                 return False
         elif message["topic"] == "invite to group":
             sender_name, group_name = message["content"].split()
             print(f"Received invite to group {group_name} from {sender_name}")
             decision = input("Do you accept the request? (yes/no): ")
             if decision.lower() == 'yes':
-                self.udpsock.sendto(json.dumps({'status': 'success'}).encode(), addr)
+                sock.sendto(json.dumps({'status': 'success'}).encode(), sender)
                 # add group
                 group_host, group_port = message["senderHost"], message["senderPort"]
                 self.groups[group_name] = {"leader": sender_name, "members": [(self.username, addr)], "address": (group_host, group_port)}
                 save_groups(self.username, self.groups)
                 #return True
             else:
-                self.udpsock.sendto(json.dumps({'status': 'reject'}).encode(), addr)
+                sock.sendto(json.dumps({'status': 'reject'}).encode(), sender)
                 #return False
         elif message["topic"] == "remove from group":
             sender_name, group_name = message["content"].split()
             print(f"You are removed from group {group_name} by {sender_name}")
             self.groups.pop(group_name)
             save_groups(self.username, self.groups)
-            self.udpsock.sendto(json.dumps({'status': 'success'}).encode(), addr)
+            sock.sendto(json.dumps({'status': 'success'}).encode(), sender)
         elif message["topic"] == "leave group":
             def find_member_index(group_name, friend_username):
                 for i, member in enumerate(self.groups[group_name]["members"]):
@@ -420,11 +906,12 @@ class P2PClient:
             print(f"{sender_name} left group {group_name}")
             if sender_name == self.username:
                 print("Leaders cannot leave group")
-                self.udpsock.sendto(json.dumps({'status': 'reject'}).encode(), addr)
+                sock.sendto(json.dumps({'status': 'reject'}).encode(), sender)
             else:
                 self.groups[group_name]["members"].pop(find_member_index(group_name, sender_name))
                 save_groups(self.username, self.groups)
-                self.udpsock.sendto(json.dumps({'status': 'success'}).encode(), addr)
+                sock.sendto(json.dumps({'status': 'success'}).encode(), sender)
+                self.report_members(group_name)
         elif message["topic"] == "broadcast":
             group_name = message["senderName"]
             sender_name = message["content"].split()[0]
@@ -432,13 +919,13 @@ class P2PClient:
             print("Group {}".format(group_name))
             print(f"{sender_name} broadcasted:")
             print(message_content)
-            self.udpsock.sendto(json.dumps({'status': 'success'}).encode(), addr)
+            sock.sendto(json.dumps({'status': 'success'}).encode(), sender)
         elif message["topic"] == "broadcast_request":
             #print("Received broadcast request from {}".format(message["senderName"]))
             group_name = message["senderName"]
             sender_name = message["content"].split()[0]
             message_content = " ".join(message["content"].split()[1:])
-            self.udpsock.sendto(json.dumps({'status': 'success'}).encode(), addr)
+            sock.sendto(json.dumps({'status': 'success'}).encode(), sender)
             self.broadcast(group_name, message_content, sender_name)
             print("Group {}".format(group_name))
             print(f"{sender_name} broadcasted:")
@@ -450,10 +937,20 @@ class P2PClient:
         elif message["topic"] == 'post':
             print("\n" + message["senderName"] + " posted:")
             print(message["content"] + "\n", end="")
+        elif message["topic"] == "presence":
+            # a watched friend changed address or status, see watch_friends;
+            # anyone can send us a datagram, only the name servers know our token
+            if message.get("token") != self.watch_token:
+                return False
+            content = message["content"]
+            friendname = content.pop("username")
+            if friendname in self.friends:
+                self._update_friends({friendname: content})
+                print("{} is now {}".format(friendname, content["status"]))
         elif message["topic"] == "message":
             print("\n" + message["senderName"] + " sent you a message:")
             print(message["content"] + "\n", end="")
-            self.udpsock.sendto(json.dumps({'status': 'success'}).encode(), addr)
+            sock.sendto(json.dumps({'status': 'success'}).encode(), sender)
         else:
             print("Received udp packet with unknown topic")
             print(message)
@@ -518,22 +1015,15 @@ class P2PClient:
             print(f"{friend_username} is not online.")
             return
         package = NSPackage('add_friend', username=self.username, friend=friend_username)
-        message, length = self._process_response(package.to_dict())
-        self._send_response_to_server(message, length)
-        data = receive_response(self.nameserverconn)
-        retry_counter = 0
-        while not data:
-            print("Receive error: cannot receive message from nameserver on lookup. Retry in {} seconds".format(2**retry_counter))
-            time.sleep(2**retry_counter)
-            self._send_response_to_server(message, length)
-            data = receive_response(self.nameserverconn)
-        response = json.loads(data)
+        response = self._request(package)
         if not response:
             return
         if response["status"] == "success":
             print(f"{friend_username} accepted your friend request.")
             self.friends[friend_username] = {'address': (friend_host, friend_port), 'status': 'online', 'last_update': time.time()}
             save_friends(self.username, self.friends)
+            if self.presence:
+                self.watch_friends([friend_username])
         else:
             print(f"{friend_username} rejected your friend request.")
 
@@ -624,19 +1114,24 @@ class P2PClient:
 
     def start_server(self,friend_username=None):
         # Implement starting the server to listen for incoming connections
+        # peers on this host may connect to our Unix socket instead
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.bind((self.host, self.port))
             s.listen()
             port = s.getsockname()[1]
             self.port = port
-            s.settimeout(10)
+            local = bind_local(self.host, self.port, 'tcp', socket.SOCK_STREAM) if self.local else None
+            listeners = [s]
+            if local:
+                local.listen()
+                listeners.append(local)
             while True:
-                try:
-                    conn, addr = s.accept()
-                    print('Connection established:', addr)
-                except socket.timeout:
+                ready, _, _ = select.select(listeners, [], [], 10)
+                if not ready:
                     print('Timeout occurred. No connection made.')
                     break
+                conn, addr = ready[0].accept()
+                print('Connection established:', addr or 'local')
                 with conn:
                     flag = False
                     self.friendconn = conn
@@ -652,6 +1147,9 @@ class P2PClient:
                         self.send_msg_to_friend(friend_username, msg)
                     if flag:
                         break
+            if local:
+                os.unlink(local.getsockname())
+                local.close()
 
 
 ### Group Chatting ###
@@ -676,19 +1174,14 @@ class P2PClient:
             self.groups[group_name] = {"is_public": True, "members": [], "leader": self.username, "address": (self.host, self.port)}
             # register with name server
             package = NSPackage('register', group_name, address=(self.host, self.port), status='online',isgroup=True)
-            message, length = self._process_response(package.to_dict())
-            self._send_response_to_server(message, length)
-            data = receive_response(self.nameserverconn)
-            retry_counter = 0
-            while not data:
-                print("Receive error: cannot receive message from nameserver on go_online. Retry in {} seconds".format(2**retry_counter))
-                time.sleep(2**retry_counter)
-                self._send_response_to_server(message, length)
-                data = receive_response(self.nameserverconn)
-            response = json.loads(data)
+            response = self._request(package)
+            if not response:
+                print("Error: cannot register with nameserver.")
+                return
             if response['status'] == 'ok':
                 print("Created public group [{}].".format(group_name))
                 save_groups(self.username, self.groups)
+                self.report_members(group_name)
             else:
                 print("Error: cannot register with nameserver.")
                 return
@@ -701,25 +1194,16 @@ class P2PClient:
         ''' Join a public group with the given name '''
         # Find the group on name server
         package = NSPackage('lookup', group_name)
-        message, length = self._process_response(package.to_dict())
-        self._send_response_to_server(message, length)
-        data = receive_response(self.nameserverconn)
-        retry_counter = 0
-        while not data:
-            print("Receive error: cannot receive message from nameserver on lookup. Retry in {} seconds".format(2**retry_counter))
-            time.sleep(2**retry_counter)
-            self._send_response_to_server(message, length)
-            data = receive_response(self.nameserverconn)
-            retry_counter += 1
-            if retry_counter > 3:
-                print("Error: cannot lookup")
-                return None
-        response = json.loads(data) # response is a dict{'address': address,'status': status,'last_update': time.time(),'isgroup': True}
-        if response:
+        response = self._read_many([package], [self._route(group_name)])[0]
+        # response is a dict{'address': address,'status': status,'last_update': time.time(),'isgroup': True}
+        if response and response.get("status") != "error" and "address" in response:
             if isinstance(response["address"], str):
                     host, port = response["address"].split()
                     port = int(port)
                     response["address"] = (host, port)
+        elif response and response.get("status") != "error":
+            print("Error: cannot lookup {} ({})".format(group_name, response["status"]))
+            return None
         else:
             print("Error: cannot lookup")
             return None
@@ -773,6 +1257,7 @@ class P2PClient:
             print("Invite to group {} is approved by {}.".format(group_name, friend_username))
             self.groups[group_name]["members"].append((friend_username, (friend_host, friend_port)))
             save_groups(self.username, self.groups)
+            self.report_members(group_name)
         else:
             print("Invite to group request to {} is denied".format(group_name))
             return False
@@ -800,6 +1285,7 @@ class P2PClient:
         if idx != -1:
             self.groups[group_name]["members"].pop(idx)
             save_groups(self.username, self.groups)
+            self.report_members(group_name)
         else:
             print("Error: friend [{}] is not in group [{}].".format(friend_username, group_name))
             return
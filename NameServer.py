@@ -1,296 +1,2453 @@
+import argparse
+import asyncio
 import socket
+import sys
 import time
 import os
+import gc
+import signal
+import stat
+import mmap
 import json
-from select import select
+import zlib
+import struct
+import heapq
+import bisect
+import array
+import hashlib
+import secrets
+import functools
+import itertools
+import operator
+import collections
+from enum import IntEnum
+from concurrent.futures import ThreadPoolExecutor
 from protocols import *
 
 # path to checkpoint and log files
 CKPT = 'catalog.ckpt'
 LOG = 'catalog.log'
-# maximum number of logs before checkpoint
-MAX_LOGS = 100
+# the log is compacted into a new checkpoint once it is LOG_RATIO of the checkpoint
+# and MIN_LOG_BYTES, MAX_LOG_BYTES, or its oldest record MAX_LOG_AGE seconds old
+MAX_LOG_BYTES = 64 << 20
+MIN_LOG_BYTES = 1 << 20
+LOG_RATIO = 0.5
+MAX_LOG_AGE = 3600.0
+# how checkpoints snapshot the catalog: 'thread' writes it from a background thread,
+# 'fork' from a forked child's copy-on-write view of it
+SNAPSHOT = 'thread'
+SNAPSHOT_MODES = ('thread', 'fork')
+# checkpoint records written between yields of the interpreter
+CKPT_YIELD = 1000
+# a binary checkpoint: header, records sorted by name, their 64-bit offsets and a
+# CRC-32 per CKPT_BLOCK bytes of records; NSCKPT01 and text checkpoints are still read
+CKPT_MAGIC = b'NSCKPT02'
+CKPT_HEADER = struct.Struct('<8sdQQQQII')
+CKPT_BLOCK = 1 << 12
+CKPT_MAGIC_V1 = b'NSCKPT01'
+CKPT_HEADER_V1 = struct.Struct('<8sdQQQQI')
+# characters of checkpoint and log records parsed at a time on recovery
+RESTORE_CHUNK = 1 << 20
+# bytes of a binary checkpoint loaded at a time once serving, and seconds
+# searches are told to retry after meanwhile
+LOAD_CHUNK = 1 << 16
+LOAD_RETRY = 1.0
+# names hashed into the Bloom filter between yields of the interpreter
+BLOOM_CHUNK = 2000
+# names added to the Bloom filter since it was last encoded that are sent to
+# clients as a list; past this many the filter is encoded again
+BLOOM_DELTA = 10000
+# when registrations are acknowledged: 'fsync' after their own log sync, 'group' after
+# one shared within COMMIT_WINDOW, 'async' at once with a sync every ASYNC_SYNC_INTERVAL
+DURABILITY = 'group'
+DURABILITY_MODES = ('fsync', 'group', 'async')
+COMMIT_WINDOW = 0.002
+ASYNC_SYNC_INTERVAL = 1.0
 
-# maximum message size to reach each time in bytes
-MSG_SIZE = 1024
+# seconds of silence before an online user is marked offline
+STALE_TIMEOUT = 120.0
+# seconds between sweeps for stale users, a sweep only touches users that are due
+STALE_INTERVAL = 5.0
+# names per block of the username index, blocks split at twice this size
+INDEX_BLOCK = 1000
+# results of a search unless the client asks for fewer, and the most it may ask for
+SEARCH_LIMIT = 20
+SEARCH_MAX = 100
+
+# rate limits, per second and burst, for requests from one client address and
+# registrations of one username; a rate of 0 turns a limit off
+ADDRESS_RATE = 100.0
+ADDRESS_BURST = 200
+USER_RATE = 1.0
+USER_BURST = 10
+# the client address of connections to the server's Unix socket, which have
+# none of their own; like clients on the loopback address, they share a limit
+LOCAL_PEER = 'unix'
+
+# ops the stats op reports latencies for one by one, others are reported as 'other'
+TIMED_OPS = frozenset(('register', 'heartbeat', 'lookup', 'lookup_many', 'search', 'list_groups', 'group_info',
+                       'add_friend', 'watch', 'ring', 'stats', 'follow', 'replicas', 'bloom', 'udp_lookup',
+                       'udp_lookup_many'))
+# latency histograms have a bucket per power of two microseconds, up to about half an hour
+HISTOGRAM_BUCKETS = 32
+
+# ops also answered over UDP on the name server's port, each request and its
+# reply in one datagram of at most MAX_DATAGRAM bytes (see protocols.py)
+DATAGRAM_OPS = frozenset(('lookup', 'lookup_many'))
+
+# seconds to wait for a user to answer a request relayed to it, such as add_friend
+RELAY_TIMEOUT = 20.0
+
+# seconds a presence watch lasts unless the subscriber renews it
+WATCH_TIMEOUT = STALE_TIMEOUT
+# seconds to wait on a client that has started but not finished a request
+CLIENT_TIMEOUT = 10.0
+# seconds before an idle client connection is closed
+IDLE_TIMEOUT = 600.0
+
+# seconds between frames on a replication stream when there are no records,
+# and how long a replica waits for one before it reconnects
+REPLICA_HEARTBEAT = 1.0
+REPLICA_TIMEOUT = 5.0
+# a replica refuses lookups once it has not heard from its primary for this long
+MAX_STALENESS = 10.0
+# users per frame when a replica is sent a snapshot of the catalog
+SNAPSHOT_CHUNK = 10000
+# ops a replica answers from its own catalog; a worker forwards the others to its server
+READ_OPS = frozenset(('lookup', 'lookup_many', 'search', 'stats'))
+
+# processes answering on the server's port: the server and workers forked from it,
+# which follow it as replicas and forward writes to it
+WORKERS = 1
+
+
+def fsync_dir(path):
+    # make a rename or file creation in the directory of path durable
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def timed_fsync(fd):
+    # sync a file descriptor, returns the seconds it took
+    start = time.perf_counter()
+    os.fsync(fd)
+    return time.perf_counter() - start
+
+
+def encode_frame(res):
+    # a message as sent on a connection, prefixed with its length
+    data = json.dumps(res).encode()
+    return len(data).to_bytes(8, "big") + data
+
+
+def format_record(name, host, port, status, isgroup=False):
+    # a checkpoint or log record, one line; groups are marked by a trailing field
+    return '{} {} {} {}{}\n'.format(name, host, port, status, ' group' if isgroup else '')
+
+
+def parse_record(line):
+    # returns name, address, status and isgroup of a record written by
+    # format_record, raises ValueError if the record is malformed
+    fields = line.split()
+    isgroup = fields[4:] == ['group']
+    if len(fields) != 4 + isgroup:
+        raise ValueError("Malformed record {!r}".format(line))
+    name, host, port, status = fields[:4]
+    return name, (host, port), status, isgroup
+
+
+def read_records(path):
+    # Map a checkpoint or log segment, returns its header line and its records as text
+    # chunks decoded as they are reached; a torn last record is left out
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return '', iter(())
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    start = mapped.find(b'\n') + 1 or len(mapped)
+    header = str(mapped[:start], 'utf-8', 'replace').rstrip('\n')
+    return header, mapped_chunks(mapped, start, mapped.rfind(b'\n') + 1, RESTORE_CHUNK)
+
+
+def mapped_chunks(mapped, start, end, size):
+    # the text of mapped[start:end] in pieces of about size bytes, each
+    # ending at a line end; closes mapped once done
+    try:
+        while start < end:
+            stop = mapped.find(b'\n', min(start + size, end) - 1, end) + 1 or end
+            yield str(mapped[start:stop], 'utf-8', 'replace')
+            start = stop
+    finally:
+        mapped.close()
+
+
+def parse_columns(text):
+    # Parse records written by format_record in bulk into the columns names, hosts, ports,
+    # statuses and isgroups; raises ValueError or KeyError on a malformed record
+    text = text.replace('\n', ' 0\n').replace(' group 0\n', ' 1\n')
+    fields = text.split()
+    if len(fields) != 5 * text.count('\n'):
+        raise ValueError("Malformed records")
+    names, hosts, ports, statuses, flags = (fields[i::5] for i in range(5))
+    if not set(flags) <= {'0', '1'}:
+        raise ValueError("Malformed records")
+    return (names, hosts, list(map(int, ports)), list(map(STATUS_VALUES.__getitem__, statuses)),
+            list(map('1'.__eq__, flags)))
+
+
+def parse_lines(text):
+    # Parse records one by one into the columns of parse_columns,
+    # skipping malformed records
+    names, hosts, ports, statuses, isgroups = [], [], [], [], []
+    for line in text.splitlines():
+        try:
+            name, (host, port), status, isgroup = parse_record(line)
+            port, status = int(port), Status.parse(status)
+        except (ValueError, KeyError):
+            continue
+        names.append(name)
+        hosts.append(host)
+        ports.append(port)
+        statuses.append(status)
+        isgroups.append(isgroup)
+    return names, hosts, ports, statuses, isgroups
+
+
+def private_dirty():
+    # bytes of this process's memory written to since it was forked, that is
+    # pages copied on write by it or its parent; None where /proc has no count
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Private_Dirty:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reap_snapshot(pid, report):
+    # Wait for a snapshot child and read its report from the pipe report,
+    # returns the report; raises if the child failed
+    with os.fdopen(report, 'rb') as f:
+        data = f.read()
+    _, status = os.waitpid(pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0 or not data:
+        raise RuntimeError("snapshot child exited with status {}".format(os.waitstatus_to_exitcode(status)))
+    return json.loads(data)
+
+
+def build_bloom(names, capacity):
+    # A Bloom filter of names sized for capacity, built in a background thread with
+    # a byte per bit set in C loops and packed as BloomFilter.positions has them
+    bloom = BloomFilter.for_capacity(capacity)
+    flags = bytearray(bloom.size)
+    hasher = functools.partial(hashlib.blake2b, digest_size=4 * bloom.hashes)
+    for start in range(0, len(names), BLOOM_CHUNK):
+        chunk = map(str.encode, names[start:start + BLOOM_CHUNK])
+        words = array.array('I', b''.join(map(operator.methodcaller('digest'), map(hasher, chunk))))
+        if sys.byteorder == 'big':
+            words.byteswap()
+        positions = map(operator.mod, words, itertools.repeat(bloom.size))
+        collections.deque(map(flags.__setitem__, positions, itertools.repeat(1)), maxlen=0)
+        # the C loops above never release the interpreter
+        time.sleep(0)
+    digits = bytes.maketrans(b'\x00\x01', b'01')
+    step = BLOOM_CHUNK * 8
+    for start in range(0, bloom.size, step):
+        chunk = flags[start:start + step]
+        packed = int(chunk[::-1].translate(digits), 2).to_bytes(len(chunk) // 8, 'little')
+        bloom.bits[start // 8:start // 8 + len(packed)] = packed
+        time.sleep(0)
+    bloom.count = len(names)
+    return bloom
+
+
+class Status(IntEnum):
+    '''User status, stored as a small int and sent as its lowercase name.'''
+    OFFLINE = 0
+    ONLINE = 1
+
+    @classmethod
+    def parse(cls, status):
+        # raises KeyError for an unknown status; the names as written to
+        # the log are looked up directly, enum lookups by name are slow
+        try:
+            return STATUS_VALUES[status]
+        except KeyError:
+            return cls[status.upper()]
+
+    def __str__(self):
+        return STATUS_NAMES[self]
+
+STATUS_NAMES = {Status.OFFLINE: 'offline', Status.ONLINE: 'online'}
+STATUS_VALUES = {name: status for status, name in STATUS_NAMES.items()}
+
+
+class Entry:
+    '''A catalog entry, slotted; equal hosts and ports are shared objects.'''
+    __slots__ = ('host', 'port', 'status', 'last_update', 'isgroup')
+
+    def __init__(self, host, port, status, last_update, isgroup=False):
+        self.host = host
+        self.port = port
+        self.status = status
+        self.last_update = last_update
+        self.isgroup = isgroup
+
+    @property
+    def address(self):
+        return (self.host, self.port)
+
+    def to_dict(self):
+        # the entry as sent in lookup responses
+        return {
+            'address': [self.host, self.port],
+            'status': STATUS_NAMES[self.status],
+            'last_update': self.last_update,
+            'isgroup': self.isgroup,
+        }
+
+
+class Watch:
+    '''A client's subscription to presence changes, pushed with its token.'''
+    __slots__ = ('address', 'expires', 'usernames', 'token')
+
+    def __init__(self, address, expires, token=None):
+        self.address = address
+        self.expires = expires
+        self.usernames = set()
+        self.token = token
+
+
+class NameIndex:
+    '''Usernames in sorted order for prefix search, kept in sorted blocks.'''
+    def __init__(self, names=()):
+        names = sorted(names)
+        self._blocks = [names[i:i+INDEX_BLOCK] for i in range(0, len(names), INDEX_BLOCK)]
+        # last name of each block
+        self._maxes = [block[-1] for block in self._blocks]
+
+    def add(self, name):
+        # insert a name that is not in the index yet
+        if not self._blocks:
+            self._blocks.append([name])
+            self._maxes.append(name)
+            return
+        i = min(bisect.bisect_left(self._maxes, name), len(self._blocks) - 1)
+        block = self._blocks[i]
+        bisect.insort(block, name)
+        self._maxes[i] = block[-1]
+        if len(block) > 2 * INDEX_BLOCK:
+            self._blocks[i:i+1] = [block[:INDEX_BLOCK], block[INDEX_BLOCK:]]
+            self._maxes[i:i+1] = [block[INDEX_BLOCK-1], block[-1]]
+
+    def extend(self, names):
+        # append sorted names that all sort after the names in the index
+        for i in range(0, len(names), INDEX_BLOCK):
+            self._blocks.append(names[i:i+INDEX_BLOCK])
+            self._maxes.append(self._blocks[-1][-1])
+
+    def snapshot(self):
+        # The names in order, to iterate from another thread while the index changes;
+        # each block is copied once reached
+        return itertools.chain.from_iterable(map(list.copy, self._blocks[:]))
+
+    def __iter__(self):
+        # the names in order
+        return itertools.chain.from_iterable(self._blocks)
+
+    def discard(self, name):
+        # remove a name if it is in the index
+        i = bisect.bisect_left(self._maxes, name)
+        if i == len(self._blocks):
+            return
+        block = self._blocks[i]
+        j = bisect.bisect_left(block, name)
+        if j == len(block) or block[j] != name:
+            return
+        del block[j]
+        if block:
+            self._maxes[i] = block[-1]
+        else:
+            del self._blocks[i]
+            del self._maxes[i]
+
+    def search(self, prefix, after=None):
+        # iterate over the names starting with prefix in order,
+        # only those after the name after if it is given
+        start = after if after is not None and after >= prefix else prefix
+        i = bisect.bisect_left(self._maxes, start)
+        if i == len(self._blocks):
+            return
+        j = bisect.bisect_right(self._blocks[i], start) if start == after else bisect.bisect_left(self._blocks[i], start)
+        for block in self._blocks[i:]:
+            for name in block[j:]:
+                if not name.startswith(prefix):
+                    return
+                yield name
+            j = 0
+
+
+class RateLimiter:
+    '''Token buckets keyed by client address or username, dropped once full.'''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, rate)
+        self.buckets = dict()
+        self.rejected = 0
+
+    def admit(self, key, now):
+        # returns 0 if the request is admitted, else the seconds until it would be
+        if not self.rate:
+            return 0
+        tokens, stamp = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            self.rejected += 1
+            return (1 - tokens) / self.rate
+        self.buckets[key] = (tokens - 1, now)
+        return 0
+
+    def prune(self, now):
+        # forget the buckets that are full again, a new bucket is the same
+        self.buckets = {key: (tokens, stamp) for key, (tokens, stamp) in self.buckets.items()
+                        if tokens + (now - stamp) * self.rate < self.burst}
+
+
+class Histogram:
+    '''Latency histogram with a bucket per power of two microseconds.'''
+    __slots__ = ('counts', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        # bucket i holds samples under 2**i microseconds, the last one all longer samples
+        i = int(seconds * 1e6).bit_length()
+        self.counts[i if i < HISTOGRAM_BUCKETS else -1] += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        # upper bound in seconds of the bucket holding the q-th quantile, 0 if empty
+        rank = q * sum(self.counts)
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** i / 1e6, self.max)
+        return self.max
+
+    def to_dict(self):
+        # the histogram as reported by the stats op, times in milliseconds;
+        # buckets maps each non-empty bucket's upper bound in microseconds to its count
+        count = sum(self.counts)
+        return {
+            'count': count,
+            'mean_ms': self.total / count * 1e3 if count else 0.0,
+            'p50_ms': self.quantile(0.50) * 1e3,
+            'p90_ms': self.quantile(0.90) * 1e3,
+            'p99_ms': self.quantile(0.99) * 1e3,
+            'max_ms': self.max * 1e3,
+            'buckets': {2 ** i: n for i, n in enumerate(self.counts) if n},
+        }
+
+
+class Metrics:
+    '''Latencies and response counts by op and status, for the stats op.'''
+    def __init__(self):
+        # {op: (Histogram, {status: responses})}
+        self.ops = dict()
+        self.timings = dict()
+        # the last value of other measures, such as 'snapshot_copied_bytes'
+        self.values = dict()
+
+    def request(self, op, seconds, status):
+        # a request answered seconds after it arrived
+        try:
+            histogram, statuses = self.ops[op]
+        except KeyError:
+            histogram, statuses = self.ops[op] = (Histogram(), dict())
+        histogram.record(seconds)
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def record(self, name, seconds):
+        # any other timing, such as 'fsync'
+        histogram = self.timings.get(name)
+        if histogram is None:
+            histogram = self.timings[name] = Histogram()
+        histogram.record(seconds)
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def to_dict(self):
+        return {
+            'ops': {op: {**histogram.to_dict(), 'statuses': dict(statuses)}
+                    for op, (histogram, statuses) in self.ops.items()},
+            **{name: histogram.to_dict() for name, histogram in self.timings.items()},
+            **self.values,
+        }
 
 
 class Catalog:
-    '''Catalog of registered users. Implemented as a dictionary of dictionaries.'''
+    '''Catalog of registered users. Implemented as a dictionary of Entry objects
+    and a min-heap of (last_update, name) of online users.'''
     def __init__(self):
         self._catalog = dict()
+        # entries are never removed on refresh; an entry whose timestamp no
+        # longer matches the user's last_update is skipped when it comes due
+        self._expiry = []
+        # one object per distinct host and port, shared by all entries using it
+        self._hosts = dict()
+        self._ports = dict()
+        # sorted usernames for search, built on first use and then kept up to date
+        self._index = None
+        # secondary index of the group entries, always up to date, and the
+        # member counts group leaders have reported, {group: members}
+        self._groups = NameIndex()
+        self._members = dict()
+        # users, not groups, whose status is online
+        self.online = 0
+        # Bloom filter of usernames for clients, None until built; names added while it
+        # is built go to _bloom_added, those added since the last bloom_snapshot to _bloom_new
+        self.bloom = None
+        self._bloom_added = None
+        self._bloom_new = []
+        # a binary checkpoint left by restore to load a chunk at a time, None once loaded,
+        # and the state of loading it (see load)
+        self._base = None
+        self._restored = 0.0
+        self._next = 0
+        self._pending = 0
+        self._ahead = 0
+        self._loaded = None
+        self._loaded_groups = None
+        self._unindexed = None
+
+    def __len__(self):
+        return len(self._catalog) + self._pending - self._ahead
+
+    @property
+    def loading(self):
+        # whether part of the checkpoint is yet to be loaded
+        return self._base is not None
+
+    def _unloaded(self, name):
+        # the Entry of a user in the checkpoint being loaded, None if it holds
+        # none; only for names not in _catalog, the entry is not kept
+        record = self._base.get(name) if self._base is not None else None
+        if record is None:
+            return None
+        try:
+            _, (host, port), status, isgroup = parse_record(record)
+            port = int(port)
+            return Entry(self._hosts.setdefault(host, host), self._ports.setdefault(port, port),
+                         Status.parse(status), self._restored, isgroup)
+        except (ValueError, KeyError):
+            return None
 
     def add(self, name, address, status, verbose=True, isgroup= False):
-        # Add a new user to the catalog or update an existing user's information
-        # address is a tuple of (host, port)
-        self._catalog[name] = {
-            'address': address,
-            'status': status,
-            'last_update': time.time(),
-            'isgroup': False,
-        }
-        if isgroup:
-            self._catalog[name]['isgroup'] = True
+        # Add a new user or update a user's information, address is (host, port);
+        # returns whether the user is new or its address, status or kind changed
+        host, port = address
+        host = self._hosts.setdefault(host, host)
+        port = int(port)
+        port = self._ports.setdefault(port, port)
+        entry = Entry(host, port, Status.parse(status), time.time(), bool(isgroup))
+        old = self._catalog.get(name)
+        # a user not loaded yet is not counted as online or as a group, the
+        # rest of the checkpoint is loaded without it
+        unloaded = self._unloaded(name) if old is None else None
+        self._catalog[name] = entry
+        if unloaded is not None:
+            self._ahead += 1
+        elif old is None and self._base is not None:
+            self._unindexed.append(name)
+        if old is None and self._index is not None:
+            self._index.add(name)
+        if old is None and self.bloom is not None:
+            self.bloom.add(name)
+            self._bloom_new.append(name)
+        if old is None and self._bloom_added is not None:
+            self._bloom_added.append(name)
+        if old is not None and old.status == Status.ONLINE and not old.isgroup:
+            self.online -= 1
+        if entry.isgroup and (old is None or not old.isgroup):
+            self._groups.add(name)
+        elif not entry.isgroup and (old or unloaded) is not None and (old or unloaded).isgroup:
+            self._groups.discard(name)
+            self._members.pop(name, None)
+        if not entry.isgroup and entry.status == Status.ONLINE:
+            heapq.heappush(self._expiry, (entry.last_update, name))
+            self.online += 1
         if verbose:
-            host, port = address
             print("Registered user {} at {}:{} as {}".format(name, host, port, status))
+        old = old or unloaded
+        return old is None or (old.host, old.port, old.status, old.isgroup) != (host, port, entry.status, entry.isgroup)
+
+    def restore(self, records, log=''):
+        # Fill an empty catalog from a checkpoint's records, parsed in bulk or left to load
+        # from a CheckpointFile, then the last record of each name in the log
+        now = time.time()
+        if isinstance(records, CheckpointFile):
+            self._base, self._restored = records, now
+            self._next, self._pending = records.start, records.count
+            self._loaded, self._loaded_groups, self._unindexed = NameIndex(), [], []
+            records = ()
+        hosts, ports = self._hosts, self._ports
+        online = []
+        groups = []
+        # millions of new objects that all live on, collecting meanwhile
+        # would only traverse them over and over
+        gc.disable()
+        try:
+            for chunk in records:
+                try:
+                    names, chunk_hosts, chunk_ports, statuses, isgroups = parse_columns(chunk)
+                except (ValueError, KeyError):
+                    # some record is malformed, skip those one by one
+                    names, chunk_hosts, chunk_ports, statuses, isgroups = parse_lines(chunk)
+                chunk_hosts = map(hosts.setdefault, chunk_hosts, chunk_hosts)
+                chunk_ports = map(ports.setdefault, chunk_ports, chunk_ports)
+                self._catalog.update(zip(names, map(Entry, chunk_hosts, chunk_ports, statuses,
+                                                    itertools.repeat(now), isgroups)))
+                # users online, not groups, all due for the stale sweep at once
+                online += itertools.compress(names, map(operator.gt, statuses, isgroups))
+                groups += itertools.compress(names, isgroups)
+            self._expiry = list(zip(itertools.repeat(now), online))
+            heapq.heapify(self._expiry)
+        finally:
+            gc.enable()
+        self._groups = NameIndex(groups)
+        self.online = len(online)
+        latest = {line.partition(' ')[0]: line for line in log.splitlines()}
+        for line in latest.values():
+            try:
+                name, address, status, isgroup = parse_record(line)
+                self.add(name, address, status, verbose=False, isgroup=isgroup)
+            except (ValueError, KeyError):
+                # invalid record, skip it
+                continue
+
+    def refresh(self, name, address):
+        # Renew the last_update of a user online at address, in memory only;
+        # returns False, changing nothing, if the user is not online there
+        user = self._catalog.get(name)
+        unloaded = user is None
+        if unloaded:
+            user = self._unloaded(name)
+        host, port = address
+        if user is None or user.isgroup or user.status != Status.ONLINE or user.address != (host, int(port)):
+            return False
+        if unloaded:
+            # kept ahead of the rest of the checkpoint, and counted from now on
+            self._catalog[name] = user
+            self._ahead += 1
+            self.online += 1
+        user.last_update = time.time()
+        heapq.heappush(self._expiry, (user.last_update, name))
+        return True
 
     def lookup(self, name):
         # Lookup a user's information
-        # return the user's dictionary, or None if not found
-        return self._catalog.get(name, None)
+        # return the user's Entry, or None if not found
+        user = self._catalog.get(name, None)
+        return user if user is not None or self._base is None else self._unloaded(name)
     
     def items(self):
-        # Return an iterator of (name, user) pairs
+        # Return an iterator of (name, user) pairs, only of the users loaded
+        # so far while loading
         return self._catalog.items()
+
+    def load(self, size=LOAD_CHUNK):
+        # Load about size bytes more of the checkpoint, keeping newer users already in the
+        # catalog; returns the addresses of the online users loaded
+        text, self._next = self._base.records(self._next, size)
+        try:
+            names, hosts, ports, statuses, isgroups = parse_columns(text)
+        except (ValueError, KeyError):
+            names, hosts, ports, statuses, isgroups = parse_lines(text)
+        self._pending -= len(names)
+        self._loaded.extend(names)
+        ahead = self._catalog.keys() & names
+        if ahead:
+            self._ahead -= len(ahead)
+            keep = [name not in ahead for name in names]
+            names, hosts, ports, statuses, isgroups = (list(itertools.compress(column, keep))
+                                                       for column in (names, hosts, ports, statuses, isgroups))
+        hosts = list(map(self._hosts.setdefault, hosts, hosts))
+        ports = list(map(self._ports.setdefault, ports, ports))
+        self._catalog.update(zip(names, map(Entry, hosts, ports, statuses, itertools.repeat(self._restored),
+                                            isgroups)))
+        online = list(map(operator.gt, statuses, isgroups))
+        collections.deque(map(heapq.heappush, itertools.repeat(self._expiry),
+                              zip(itertools.repeat(self._restored), itertools.compress(names, online))), maxlen=0)
+        self.online += sum(online)
+        self._loaded_groups += itertools.compress(names, isgroups)
+        if self._next == self._base.end:
+            self._index, self._loaded = self._loaded, None
+            for name in self._unindexed:
+                self._index.add(name)
+            self._groups = NameIndex(self._loaded_groups + list(self._groups))
+            self._base.close()
+            self._base = self._loaded_groups = self._unindexed = None
+            self._pending = self._ahead = 0
+        return list(itertools.compress(zip(hosts, ports), online))
+
+    def index(self):
+        # Build the username index if not built yet and return it; not while loading
+        if self._index is None:
+            self._index = NameIndex(self._catalog)
+        return self._index
+
+    def search(self, prefix, limit, after=None, groups=False):
+        # Return up to limit (name, user) pairs whose names start with prefix and follow
+        # after, and whether there are more; only groups if groups is set
+        index = self._groups if groups else self.index()
+        names = index.search(prefix, after)
+        found = [(name, self._catalog[name]) for name in itertools.islice(names, limit)]
+        return found, next(names, None) is not None
+
+    def bloom_names(self):
+        # The names to build a Bloom filter of; names added from now on are
+        # kept until the filter is handed over with set_bloom
+        self._bloom_added = []
+        return list(self._catalog)
+
+    def set_bloom(self, bloom):
+        # Take over a Bloom filter built of bloom_names, adding the names
+        # added since; None if it could not be built
+        if bloom is not None:
+            for name in self._bloom_added:
+                bloom.add(name)
+            self.bloom = bloom
+            self._bloom_new = []
+        self._bloom_added = None
+
+    def bloom_snapshot(self):
+        # A copy of the Bloom filter as it is now; names added from now on are
+        # kept for bloom_since
+        self._bloom_new = []
+        return BloomFilter(self.bloom.size, self.bloom.hashes, self.bloom.bits, self.bloom.count)
+
+    def bloom_since(self, count):
+        # The names added to the Bloom filter since it held count names, None
+        # if that was before the last bloom_snapshot
+        start = count - (self.bloom.count - len(self._bloom_new))
+        return self._bloom_new[start:] if 0 <= start <= len(self._bloom_new) else None
+
+    def set_members(self, name, members):
+        # Record the member count a group's leader reported
+        user = self.lookup(name)
+        if user is None or not user.isgroup:
+            raise KeyError(name)
+        self._members[name] = int(members)
+
+    def members(self, name):
+        # The member count last reported for a group, None if unknown
+        return self._members.get(name)
+
+    def rows(self, names):
+        # [name, host, port, status, isgroup] of the names still in the catalog
+        rows = []
+        for name in names:
+            user = self._catalog.get(name)
+            if user is not None:
+                rows.append([name, user.host, user.port, STATUS_NAMES[user.status], user.isgroup])
+        return rows
+
+    def snapshot(self, copy=True):
+        # Return the catalog and its names in order for Checkpoint.save, names copied a
+        # block at a time; without copy, for a forked child, not copied at all
+        if not copy:
+            return self._catalog, iter(self.index())
+        return self._catalog, self.index().snapshot()
     
-    def update_stale(self, verbose=True):
-        # Update status of stale users to 'offline' if they haven't been updated in 120 seconds
-        ts = time.time()
+    def update_stale(self, verbose=True, mark=True):
+        # Update status of stale users to 'offline' if they haven't been updated in STALE_TIMEOUT seconds
+        # visiting only due heap entries; without mark these are only dropped, for a replica
+        deadline = time.time() - STALE_TIMEOUT
         updated = []
-        for name, user in self._catalog.items():
-            if user['isgroup']:
+        while self._expiry and self._expiry[0][0] < deadline:
+            last_update, name = heapq.heappop(self._expiry)
+            user = self._catalog.get(name)
+            if user is None or user.last_update != last_update or user.isgroup:
+                # refreshed or re-registered since this entry was pushed
                 continue
-            if ts - user['last_update'] > 120.0 and user['status'] == 'online':
-                self._catalog[name]["status"] = 'offline'
+            if mark and user.status == Status.ONLINE:
+                user.status = Status.OFFLINE
+                self.online -= 1
                 if verbose:
                     print("Updated stale user {} as offline".format(name))
-                updated.append((name, user['address'], user['status']))
+                updated.append((name, user.address, str(user.status)))
         return updated
 
+class CheckpointFile:
+    '''A binary checkpoint mapped into memory, searched by name and loaded a
+    chunk at a time; blocks of records are verified when first read.'''
+    def __init__(self, f):
+        # f is the checkpoint opened in binary; raises ValueError if it is
+        # not a complete binary checkpoint with a matching checksum
+        self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapped)
+        self.index = self.crcs = None
+        try:
+            magic = self.mapped[:len(CKPT_MAGIC)]
+            header = CKPT_HEADER if magic == CKPT_MAGIC else CKPT_HEADER_V1
+            if len(self.mapped) < header.size:
+                raise ValueError("Truncated checkpoint header")
+            if magic == CKPT_MAGIC:
+                _, self.ts, self.seq, self.offset, self.count, size, self.block, crc = header.unpack_from(self.mapped)
+                if not self.block:
+                    raise ValueError("Malformed checkpoint header")
+                blocks = -(-size // self.block)
+            elif magic == CKPT_MAGIC_V1:
+                _, self.ts, self.seq, self.offset, self.count, size, crc = header.unpack_from(self.mapped)
+                blocks = 0
+            else:
+                raise ValueError("Not a binary checkpoint")
+            # records are from start to end, their offsets from end on, then
+            # the checksums of their blocks
+            self.start = header.size
+            self.end = self.start + size
+            if len(self.mapped) != self.end + 8 * self.count + 4 * blocks:
+                raise ValueError("Truncated checkpoint")
+            if magic == CKPT_MAGIC:
+                checked = zlib.crc32(self.view[self.end:], zlib.crc32(self.view[:header.size - 4]))
+            else:
+                # the older format has one checksum, records and all
+                checked = zlib.crc32(self.view[self.start:])
+            if checked != crc:
+                raise ValueError("Checkpoint checksum mismatch")
+            self.index = self.array(self.end, self.end + 8 * self.count, 'Q')
+            if blocks:
+                self.crcs = self.array(self.end + 8 * self.count, len(self.mapped), 'I')
+                self.verified = bytearray(blocks)
+        except ValueError:
+            self.close()
+            raise
+
+    def array(self, start, end, typecode):
+        # the little-endian integers from start to end
+        if sys.byteorder == 'little':
+            return self.view[start:end].cast(typecode)
+        values = array.array(typecode)
+        values.frombytes(self.view[start:end])
+        values.byteswap()
+        return values
+
+    def verify(self, start, end):
+        # check the blocks of the bytes from start to end not checked yet;
+        # raises ValueError if one does not match its checksum
+        if self.crcs is None or end <= start:
+            return
+        for i in range((start - self.start) // self.block, (end - 1 - self.start) // self.block + 1):
+            if not self.verified[i]:
+                block = self.start + i * self.block
+                if zlib.crc32(self.view[block:min(block + self.block, self.end)]) != self.crcs[i]:
+                    raise ValueError("Checkpoint checksum mismatch in block {}".format(i))
+                self.verified[i] = 1
+
+    def name_at(self, i):
+        # the name of record i, encoded
+        start = self.start + self.index[i]
+        end = self.mapped.find(b' ', start, self.end)
+        self.verify(start, end + 1 if end >= 0 else self.end)
+        return self.mapped[start:end]
+
+    def get(self, name):
+        # the record of name, None if there is none
+        key = name.encode()
+        i = bisect.bisect_left(range(self.count), key, key=self.name_at)
+        if i == self.count or self.name_at(i) != key:
+            return None
+        end = self.start + self.index[i + 1] if i + 1 < self.count else self.end
+        self.verify(self.start + self.index[i], end)
+        return str(self.mapped[self.start + self.index[i]:end], 'utf-8', 'replace')
+
+    def records(self, start, size):
+        # the records from byte start on, about size bytes of them up to the
+        # end of a record, and the byte after them
+        end = min(start + size, self.end)
+        if end > start:
+            end = self.mapped.find(b'\n', end - 1, self.end) + 1 or self.end
+        self.verify(start, end)
+        return str(self.mapped[start:end], 'utf-8', 'replace'), end
+
+    def close(self):
+        for values in (self.index, self.crcs):
+            if isinstance(values, memoryview):
+                values.release()
+        self.view.release()
+        self.mapped.close()
+
+
 class Checkpoint:
     '''Checkpoint class for periodically saving catalog to disk.'''
     def __init__(self, path):
         self.path = path
+        # bytes of the checkpoint on disk
+        self.size = 0
 
-    def save(self, catalog: Catalog, ts: float):
-        # Save catalog to disk by shadowing
-        with open(self.path+'.tmp', 'w') as f:
-            f.write(str(ts)+'\n')
-            for name, user in catalog.items():
-                if isinstance(user['address'], list) or isinstance(user['address'], tuple):
-                    user['address'] = ' '.join(map(str, user['address']))
-                f.write(' '.join([name, user['address'], user['status']])+'\n')
+    def save(self, snapshot: tuple, ts: float, seq: int, offset: int = 0):
+        # Save a snapshot from Catalog.snapshot to disk by shadowing, returns its size;
+        # seq and offset are where the log goes on after the snapshot
+        users, names = snapshot
+        names = iter(names)
+        offsets = array.array('Q')
+        # checksums of the full blocks of records, crc that of the block being filled
+        crcs = array.array('I')
+        size = crc = 0
+        with open(self.path+'.tmp', 'wb') as f:
+            # the header goes in last, once the records are counted and summed
+            f.seek(CKPT_HEADER.size)
+            while True:
+                batch = list(itertools.islice(names, CKPT_YIELD))
+                if not batch:
+                    break
+                records = [format_record(name, user.host, user.port, STATUS_NAMES[user.status], user.isgroup)
+                           for name, user in zip(batch, map(users.get, batch)) if user is not None]
+                data = ''.join(records).encode()
+                # offsets are in bytes, which only ASCII records have as many as characters
+                lengths = map(len, records if data.isascii() else map(str.encode, records))
+                offsets.extend(itertools.accumulate(lengths, initial=size))
+                filled = size % CKPT_BLOCK
+                size = offsets.pop()
+                f.write(data)
+                data = memoryview(data)
+                while data:
+                    part = data[:CKPT_BLOCK - filled]
+                    crc = zlib.crc32(part, crc)
+                    filled += len(part)
+                    data = data[len(part):]
+                    if filled == CKPT_BLOCK:
+                        crcs.append(crc)
+                        crc = filled = 0
+                # a background save is not urgent
+                time.sleep(0)
+            if size % CKPT_BLOCK:
+                crcs.append(crc)
+            if sys.byteorder == 'big':
+                offsets.byteswap()
+                crcs.byteswap()
+            f.write(offsets)
+            f.write(crcs)
+            # the header's checksum covers the rest of it, the offsets and the block checksums
+            header = (CKPT_MAGIC, ts, seq, offset, len(offsets), size, CKPT_BLOCK)
+            crc = zlib.crc32(crcs, zlib.crc32(offsets, zlib.crc32(CKPT_HEADER.pack(*header, 0)[:-4])))
+            f.seek(0)
+            f.write(CKPT_HEADER.pack(*header, crc))
             f.flush()
-        os.sync()
+            os.fsync(f.fileno())
+            self.size = CKPT_HEADER.size + size + 8 * len(offsets) + 4 * len(crcs)
         os.rename(self.path+'.tmp', self.path)
-    
-    def load(self):
-        # Load catalog from disk, returns a catalog object and timestamp
-        catalog = Catalog()
+        fsync_dir(self.path)
+        return self.size
+
+    def read(self):
+        # Read the checkpoint for Catalog.restore, returns its records, timestamp and log
+        # position; raises ValueError if it is torn or corrupt, see set_aside
         try:
-            with open(self.path, 'r') as f:
-                ts = float(f.readline().strip())
-                for line in f.read().splitlines():
-                    name, host, port, status = line.split()
-                    catalog.add(name, (host,port), status, verbose=False)
+            with open(self.path, 'rb') as f:
+                if f.read(len(CKPT_MAGIC)) in (CKPT_MAGIC, CKPT_MAGIC_V1):
+                    records = CheckpointFile(f)
+                    ts, seq, offset = records.ts, records.seq, records.offset
+                else:
+                    # written before checkpoints were binary, loaded in full once
+                    header, records = read_records(self.path)
+                    header = header.split()
+                    ts = float(header[0])
+                    # checkpoints written before log segments only carry a timestamp
+                    seq = int(header[1]) if len(header) > 1 else 0
+                    offset = int(header[2]) if len(header) > 2 else 0
         except FileNotFoundError:
-            ts = 0.0
-        return catalog, ts
+            return '', 0.0, 0, 0
+        except (ValueError, IndexError) as e:
+            raise ValueError("Checkpoint {} is unusable: {}".format(self.path, e))
+        self.size = os.path.getsize(self.path)
+        return records, ts, seq, offset
+
+    def set_aside(self):
+        # move an unusable checkpoint out of the way, to path.corrupt
+        os.replace(self.path, self.path + '.corrupt')
+
+    def load(self):
+        # Load a replica's checkpoint, returns a catalog, timestamp and log position; an
+        # unusable one is set aside and the primary sends the whole catalog again
+        try:
+            records, ts, seq, offset = self.read()
+        except ValueError as e:
+            print("{}, fetching the catalog from the primary again".format(e))
+            self.set_aside()
+            records, ts, seq, offset = '', 0.0, 0, 0
+        catalog = Catalog()
+        catalog.restore(records)
+        return catalog, ts, seq, offset
 
 class Log:
-    '''Log class for recording updates'''
-    def __init__(self, path):
+    '''Log class for recording updates, in segments path.0, path.1, ...'''
+    def __init__(self, path, durability=DURABILITY, metrics=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError("Unknown durability mode {}".format(durability))
         self.path = path
+        self.durability = durability
+        self.metrics = metrics or Metrics()
+        self.log = None
+        self.seq = 0
+        # rotated segments, kept open until retired as a sync may still be using them
+        self.rotated = []
+        # bytes of records since the last checkpoint, and when the oldest of them was written
+        self.size = 0
+        self.since = None
+        # records in the current segment
+        self.records = 0
+
+    def segment_path(self, seq):
+        return '{}.{}'.format(self.path, seq)
+
+    def segments(self):
+        # sequence numbers of the segments on disk, in order
+        directory, prefix = os.path.split(os.path.abspath(self.path))
+        seqs = []
+        for filename in os.listdir(directory):
+            if filename.startswith(prefix+'.') and filename[len(prefix)+1:].isdigit():
+                seqs.append(int(filename[len(prefix)+1:]))
+        return sorted(seqs)
+
+    def playback(self, ckpt_ts: float, ckpt_seq: int):
+        # returns the records of the segments the checkpoint does not cover, oldest
+        # first; new appends go to a fresh segment
+        if os.path.exists(self.path):
+            # log written before segments, keep it only if the checkpoint is older
+            with open(self.path, 'r') as f:
+                log_ts = float(f.readline().strip() or 0.0)
+            if log_ts >= ckpt_ts and not self.segments():
+                os.rename(self.path, self.segment_path(ckpt_seq))
+            else:
+                os.remove(self.path)
+        seqs = self.segments()
+        segments = [(header, ''.join(chunks)) for header, chunks in
+                    (read_records(self.segment_path(seq)) for seq in seqs if seq >= ckpt_seq)]
+        records = ''.join(segment_records for _, segment_records in segments)
+        self.size = len(records)
+        # a segment's header is the time it was started
+        self.since = next((float(header) for header, segment_records in segments if segment_records), None)
+        self.open_segment(max(seqs + [ckpt_seq - 1]) + 1, time.time())
+        self.retire(ckpt_seq)
+        return records
+
+    def open_segment(self, seq, ts, sync=True):
+        # create segment seq, starting with its timestamp, and append to it;
+        # without sync, see sync_segments
+        self.seq = seq
+        self.records = 0
+        self.log = open(self.segment_path(seq), 'w')
+        self.log.write(str(ts)+'\n')
+        if sync:
+            self.sync()
+            fsync_dir(self.path)
+
+    def rotate(self, ts, sync=True) -> int:
+        # continue in a new segment, returns its number; without sync, see sync_segments
+        if sync:
+            self.sync()
+        self.rotated.append(self.log)
+        self.open_segment(self.seq + 1, ts, sync)
+        self.size = 0
+        self.since = None
+        return self.seq
+
+    def sync_segments(self, fds):
+        # sync the segments rotate left unsynced, and the new one's directory
+        # entry; closes fds, returns the seconds it took
+        start = time.perf_counter()
         try:
-            self.log = open(self.path, 'r+')
-        except FileNotFoundError:
-            with open(self.path, 'w+') as f:
-                f.write('0.0\n')
-                f.flush()
-                os.fsync(f.fileno())
-            self.log = open(self.path, 'r+')
-        self.length = 0
-    
-    def playback(self, catalog: Catalog, ckpt_ts: float):
-        # playback log file, update catalog, and skip incomplete logs
-        # if log is stale, truncate it and return the original catalog
-        # else, return new catalog updated with log
-        log_ts = float(self.log.readline().strip())
-        if log_ts < ckpt_ts:
-            # log is stale, truncate it
-            self.truncate(ckpt_ts)
-            return catalog
-        else:
-            for line in self.log.read().splitlines():
-                try:
-                    name, host, port, status = line.split()
-                    catalog.add(name, (host, port), status, verbose=False)
-                    self.length += 1
-                except ValueError:
-                    # invalid record, skip it
-                    continue
-            return catalog
+            for fd in fds:
+                os.fsync(fd)
+            fsync_dir(self.path)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        return time.perf_counter() - start
 
-    def append(self, name, address, status) -> int:
+    def retire(self, seq):
+        # remove segments older than seq, a checkpoint now covers them
+        for old in self.segments():
+            if old < seq:
+                os.remove(self.segment_path(old))
+        for f in self.rotated:
+            f.close()
+        self.rotated = []
+
+    def append(self, name, address, status, isgroup=False):
         # append a new record to log file
-        address = ' '.join(map(str, address))
-        self.log.write(' '.join([name, address, status])+'\n')
-        self.log.flush()
-        os.sync()
-        self.length += 1
-        return self.length
-
-    def truncate(self, ts):
-        # truncate log file
-        self.log.truncate(0)
-        self.log.seek(0)
-        # write current timestamp
-        self.log.write(str(ts)+'\n')
+        # only 'fsync' durability syncs here, otherwise see GroupCommit
+        host, port = address
+        record = format_record(name, host, port, status, isgroup)
+        self.log.write(record)
+        if self.durability == 'fsync':
+            self.sync()
+        if self.since is None:
+            self.since = time.time()
+        self.size += len(record)
+        self.records += 1
+
+    def position(self):
+        # (segment, record) of the last appended record, records count from 1
+        return (self.seq, self.records)
+
+    def read_since(self, seq, offset, end):
+        # the records after (seq, offset) up to end as [seq, record, name, host, port, status,
+        # isgroup], read as iterated; None if the position is not on disk
+        seqs = [s for s in self.segments() if seq <= s <= end[0]]
+        if not seqs or seq != seqs[0] or (seq, offset) > end:
+            return None
+        return self._read_records(seqs, seq, offset, end)
+
+    def _read_records(self, seqs, seq, offset, end):
+        for s in seqs:
+            with open(self.segment_path(s), 'r') as f:
+                f.readline()
+                for i, line in enumerate(f, 1):
+                    if (s, i) > end:
+                        break
+                    if s == seq and i <= offset:
+                        continue
+                    try:
+                        name, (host, port), status, isgroup = parse_record(line)
+                    except ValueError:
+                        continue
+                    yield [s, i, name, host, int(port), status, isgroup]
+
+    def flush(self):
+        # hand buffered records to the OS, returns the descriptor to fsync
         self.log.flush()
-        os.sync()
-        self.length = 0
+        return self.log.fileno()
+
+    def sync(self):
+        # make every appended record durable
+        self.metrics.record('fsync', timed_fsync(self.flush()))
+
+
+class GroupCommit:
+    '''Acknowledges log appends once durable, one fsync per commit window.'''
+    def __init__(self, log: Log, loop):
+        self.log = log
+        self.loop = loop
+        self.waiters = []
+        self.timer = None
+        self.syncing = False
+        # log position up to which records are known to be on disk
+        self.synced = log.position()
+        # syncs get their own thread so checkpoints and relays never delay them
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        if log.durability == 'async':
+            self.loop.call_later(ASYNC_SYNC_INTERVAL, self.sync_periodically)
+
+    def durable(self, res):
+        # returns res once everything appended so far is durable:
+        # directly if it already is, else as a future resolving to it
+        if self.log.durability != 'group' or self.log.position() == self.synced:
+            return res
+        waiter = self.loop.create_future()
+        self.waiters.append((waiter, res))
+        if not self.timer and not self.syncing:
+            self.timer = self.loop.call_later(COMMIT_WINDOW, self.commit)
+        return waiter
+
+    def commit(self):
+        # sync the current group in the executor, new appends form the next
+        self.timer = None
+        waiters, self.waiters = self.waiters, []
+        self.syncing = True
+        position = self.log.position()
+        fsync = self.loop.run_in_executor(self.executor, timed_fsync, self.log.flush())
+        fsync.add_done_callback(lambda f: self.committed(waiters, f, position))
+
+    def committed(self, waiters, fsync, position):
+        self.syncing = False
+        failed = self.record_sync(fsync) is None
+        if not failed:
+            self.synced = position
+        for waiter, res in waiters:
+            if not waiter.done():
+                waiter.set_result({'status': 'error'} if failed else res)
+        if self.waiters:
+            self.timer = self.loop.call_later(COMMIT_WINDOW, self.commit)
+
+    def rotate(self, ts):
+        # Log.rotate with the syncs in the commit thread, ahead of the syncs
+        # of later appends; 'fsync' durability syncs in place
+        if self.log.durability == 'fsync':
+            return self.log.rotate(ts)
+        old = os.dup(self.log.flush())
+        seq = self.log.rotate(ts, sync=False)
+        fds = (old, os.dup(self.log.flush()))
+        fsync = self.loop.run_in_executor(self.executor, self.log.sync_segments, fds)
+        fsync.add_done_callback(self.record_sync)
+        return seq
+
+    def sync_periodically(self):
+        # 'async' durability: appends are acknowledged at once and synced here
+        fsync = self.loop.run_in_executor(self.executor, timed_fsync, self.log.flush())
+        fsync.add_done_callback(self.record_sync)
+        self.loop.call_later(ASYNC_SYNC_INTERVAL, self.sync_periodically)
+
+    def record_sync(self, fsync):
+        # a sync finished; returns how long it took, or None if it failed
+        if fsync.exception() is not None:
+            print("Log sync failed: {}".format(fsync.exception()))
+            return None
+        self.log.metrics.record('fsync', fsync.result())
+        return fsync.result()
+
+
+class NSProtocol(asyncio.Protocol):
+    '''Connection handler speaking the 8-byte length-prefixed protocol.'''
+    def __init__(self, server, internal=False):
+        self.server = server
+        self.internal = internal
+        self.buffer = bytearray()
+        self.transport = None
+        self.timer = None
+        # set by the server when the client's address runs over its rate limit
+        self.throttled = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections += 1
+        sock = transport.get_extra_info('socket')
+        if sock.family == socket.AF_INET:
+            address = transport.get_extra_info('peername')
+            self.peer = address[0]
+            print("Connection from {}:{}".format(address[0], address[1]))
+            # replies to pipelined requests are small, send them without waiting for acks
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.peer = LOCAL_PEER
+            print("Connection from {}{}".format(UNIX_PREFIX, self.server.unix))
+        self.reset_timer()
+
+    def connection_lost(self, exc):
+        self.timer.cancel()
+        self.transport = None
+        self.server.connections -= 1
+        self.server.followers.pop(self, None)
+        self.server.joining.pop(self, None)
+
+    def reset_timer(self):
+        # drop clients that stall mid-request, or that stay idle for too long
+        if self.timer:
+            self.timer.cancel()
+        timeout = CLIENT_TIMEOUT if self.buffer else IDLE_TIMEOUT
+        self.timer = self.server.loop.call_later(timeout, self.transport.close)
+
+    def data_received(self, data):
+        self.buffer += data
+        offset = 0
+        while len(self.buffer) - offset >= 8:
+            length = int.from_bytes(self.buffer[offset:offset+8], "big")
+            if len(self.buffer) - offset - 8 < length:
+                break
+            msg = bytes(self.buffer[offset+8:offset+8+length])
+            offset += 8 + length
+            res = self.server.handle_request(msg, self)
+            if isinstance(res, asyncio.Future):
+                res.add_done_callback(lambda f: self.reply(f.result()))
+            else:
+                self.reply(res)
+            if self.throttled:
+                break
+        del self.buffer[:offset]
+        if self.transport:
+            self.reset_timer()
+        if self.throttled and self.transport:
+            # stop reading until the client's bucket refills, so a flood costs
+            # the server a rejection per wait rather than one per request
+            self.transport.pause_reading()
+            self.server.loop.call_later(self.throttled, self.resume)
+
+    def resume(self):
+        # read again after a throttle, starting with requests already buffered
+        self.throttled = 0
+        if self.transport:
+            self.transport.resume_reading()
+            self.data_received(b'')
+
+    def reply(self, res):
+        # Send response, unless the client has gone away meanwhile
+        self.send(encode_frame(res))
+
+    def send(self, data):
+        # Send frames encoded by encode_frame, unless the client has gone away
+        if self.transport:
+            self.transport.write(data)
+
+
+class RelayProtocol(asyncio.DatagramProtocol):
+    '''Receives users' answers to the requests the name server relays to them.'''
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        try:
+            response = json.loads(data.decode())
+        except ValueError:
+            return
+        if isinstance(response, dict):
+            self.server.relayed(response, addr)
+
+    def error_received(self, exc):
+        # an absent user, its request simply times out
+        pass
+
+
+class LookupProtocol(asyncio.DatagramProtocol):
+    '''Answers lookups sent as datagrams to the name server's own port.'''
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        reply = self.server.handle_datagram(data, addr)
+        if reply is not None:
+            self.transport.sendto(reply, addr)
+
+    def error_received(self, exc):
+        # the client went away before its reply, it will ask again
+        pass
+
+
+class Upstream:
+    '''A worker's pipelined connection to its server for forwarded requests.'''
+    def __init__(self, address):
+        self.address = address
+        self.writer = None
+        self.connecting = None
+        self.reading = None
+        # {request id: future of the reply}
+        self.pending = {}
+        self.next_id = 0
+
+    async def connect(self):
+        try:
+            reader, self.writer = await asyncio.wait_for(asyncio.open_connection(*self.address), CLIENT_TIMEOUT)
+            self.reading = asyncio.ensure_future(self.read(reader))
+        finally:
+            self.connecting = None
+
+    async def request(self, msg):
+        # the server's reply to msg
+        try:
+            if self.writer is None:
+                self.connecting = self.connecting or asyncio.ensure_future(self.connect())
+                await asyncio.shield(self.connecting)
+        except (OSError, asyncio.TimeoutError):
+            return {'status': 'error'}
+        self.next_id += 1
+        reply = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = reply
+        message = json.dumps({**msg, 'id': self.next_id}).encode()
+        self.writer.write(len(message).to_bytes(8, "big") + message)
+        return await reply
+
+    async def read(self, reader):
+        try:
+            while True:
+                sz = await reader.readexactly(8)
+                res = json.loads((await reader.readexactly(int.from_bytes(sz, "big"))).decode())
+                reply = self.pending.pop(res.pop('id', None), None)
+                if reply is not None and not reply.done():
+                    reply.set_result(res)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.writer.close()
+            self.writer = None
+            for reply in self.pending.values():
+                if not reply.done():
+                    reply.set_result({'status': 'error'})
+            self.pending = {}
 
 
 class NameServer:
     '''Name server for user discovery.'''
-    def __init__(self, host=None, port=0):
+    def __init__(self, host=None, port=0, durability=DURABILITY, max_log_bytes=MAX_LOG_BYTES, ring=None, shard=None,
+                 primary=None, max_staleness=MAX_STALENESS, address_rate=ADDRESS_RATE, user_rate=USER_RATE,
+                 max_log_age=MAX_LOG_AGE, snapshot=SNAPSHOT, workers=WORKERS, unix=None, peer_secret=None):
+        # With ring, this server is shard number shard, and requests carrying peer_secret
+        # are from other shards; with primary, a read replica of that server. workers is
+        # the number of processes on the port, unix the path of a socket for local clients
+        self.ring = ring
+        self.shard = shard
+        self.peer_secret = peer_secret
+        self.primary = tuple(primary) if primary else None
+        self.max_staleness = max_staleness
+        ckpt_path, log_path = CKPT, LOG
+        if ring:
+            host, port = ring.shards[shard]
+            ckpt_path = 'shard{}-{}'.format(shard, CKPT)
+            log_path = 'shard{}-{}'.format(shard, LOG)
+        # request latencies and other timings, for the stats op
+        self.metrics = Metrics()
+        self.started = time.time()
+        self.connections = 0
         # Initialize catalog from checkpoint file and playback log
+        start = time.perf_counter()
         self.catalog = Catalog()
-        # Read checkpoint file
-        self.ckpt = Checkpoint(CKPT)
-        self.catalog, self.ckpt_ts = self.ckpt.load()
-        # Read log file
-        self.log = Log(LOG)
-        self.catalog = self.log.playback(self.catalog, self.ckpt_ts)
+        if self.primary:
+            # a replica has no log, its checkpoint records the position in the
+            # primary's log it covers and the stream resumes from there
+            self.ckpt = Checkpoint('replica-' + CKPT)
+            self.catalog, self.ckpt_ts, seq, offset = self.ckpt.load()
+            self.position = (seq, offset) if self.ckpt_ts else None
+            self.log = None
+        else:
+            # Read checkpoint file
+            self.ckpt = Checkpoint(ckpt_path)
+            self.log = Log(log_path, durability, self.metrics)
+            try:
+                records, self.ckpt_ts, ckpt_seq, _ = self.ckpt.read()
+            except ValueError as e:
+                self.recover_without_checkpoint(e)
+                records, self.ckpt_ts, ckpt_seq = '', 0.0, 0
+            if not self.ckpt_ts and self.log.segments()[:1] > [0]:
+                print("WARNING: no checkpoint, but log segments before {} were compacted into one and removed."
+                      " Users not registered since are lost".format(self.log.segments()[0]))
+            # Read log file
+            log = self.log.playback(self.ckpt_ts, ckpt_seq)
+            self.catalog.restore(records, log)
+            del records, log
+        self.max_log_bytes = max_log_bytes
+        self.max_log_age = max_log_age
+        if snapshot not in SNAPSHOT_MODES:
+            raise ValueError("Unknown snapshot mode {}".format(snapshot))
+        self.snapshot = snapshot
+        # index usernames now rather than on the first search; a catalog
+        # still to load from a binary checkpoint is indexed as it loads
+        if not self.catalog.loading:
+            self.catalog.index()
+        recovery = time.perf_counter() - start
+        self.metrics.record('recovery', recovery)
+        print("Recovered {} users in {:.2f}s".format(len(self.catalog), recovery))
+        # the recovered catalog lives as long as the server, later garbage
+        # collections need not traverse it
+        gc.freeze()
+        # replication: a primary's followers and records to ship to them; a replica's last
+        # contact with its primary and the records applied since its checkpoint
+        self.followers = {}
+        self.joining = {}
+        self.shipping = []
+        self.heard = 0.0
+        self.applied = 0
+        self.applied_since = None
+        self.incoming = None
+        # presence watches: {subscriber: Watch}, {watched username: subscribers},
+        # and a min-heap of (expires, subscriber) with lazy deletion as for stale users
+        self.watches = {}
+        self.watchers = {}
+        self.watch_expiry = []
+        # admission control; other shards relay for many users, never limit them
+        self.address_limits = RateLimiter(address_rate, ADDRESS_BURST)
+        self.user_limits = RateLimiter(user_rate, USER_BURST)
+        # requests relayed to users over UDP, {relay id: (future, user address)}; ids are
+        # random so that others cannot answer in the user's place
+        self.relays = {}
+        # checkpoints are written by a background thread, one at a time
+        self.ckpt_executor = ThreadPoolExecutor(max_workers=1)
+        self.checkpointing = False
+        # so is the Bloom filter of usernames, on first request; the filter
+        # last sent is kept encoded until names are added to it
+        self.bloom_building = False
+        # the filter last encoded for clients: (filter, version, encoding), see bloom
+        self.bloom_encoded = (None, (None, 0), None)
+
+        # workers: a server's {pid: worker number}; a worker's number, 0 in the server, its
+        # connection to the server and forwarded writes waiting to be applied here
+        self.workers = {}
+        self.worker = 0
+        self.upstream = None
+        self.catching_up = []
 
         # initialize socket
         host = host if host else socket.gethostname()
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.s.bind((host, port))
-        self.s.listen(5)
-        self.host, self.port = self.s.getsockname()
+        self.bind(host, port, reuse_port=workers > 1)
+        self.internal = None
+        if workers > 1:
+            # workers follow the server and forward to it through a socket of its own
+            self.internal = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.internal.bind((self.host, 0))
+            self.internal.listen(workers)
         print("Name server listening on {}:{}".format(self.host, self.port))
+        self.unix = unix
+        self.local = self.bind_unix(unix) if unix else None
+        if workers > 1 and self.start_workers(workers - 1):
+            return
 
-        # send UDP broadcast to known online users in the catalog
+        if self.primary:
+            return
+        # send UDP broadcast to known online users in the catalog, those
+        # still to load from the checkpoint are sent it as they load
         broadcast = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        package = UDPPackage('NAMESERVER', self.host, self.port, 'address update')
+        package = str(UDPPackage('NAMESERVER', self.host, self.port, 'address update')).encode()
         for name, user in self.catalog.items():
-            if user['status'] == 'online':
-                ip_addr, port = user['address']
-                port = int(port)
-                broadcast.sendto(str(package).encode(), (ip_addr, port))
+            if user.status == Status.ONLINE:
+                broadcast.sendto(package, user.address)
         broadcast.close()
 
+    def recover_without_checkpoint(self, error, serving=False):
+        # The checkpoint is unusable: recover from the log if it holds every record, else
+        # refuse to start rather than lose users; found while serving, stop either way
+        segments = self.log.segments()
+        if segments and segments[0] == 0:
+            self.ckpt.set_aside()
+            if serving:
+                print("FATAL: {}, set aside; restart to recover from the log, which holds every record".format(error))
+                raise SystemExit(1)
+            print("{}, recovering from the log, which holds every record".format(error))
+            return
+        print("FATAL: {}".format(error))
+        if segments:
+            print("FATAL: log segments 0 to {} were compacted into it and removed; without it, the"
+                  " users last registered in them are lost".format(segments[0] - 1))
+        else:
+            print("FATAL: there is no log, every user is in the checkpoint")
+        print("FATAL: restore {} from a backup, or move it aside to start without those users".format(self.ckpt.path))
+        raise SystemExit(1)
+
+    def bind(self, host, port, reuse_port=False):
+        # Open the listening socket and the datagram socket for lookups on
+        # (host, port); with reuse_port, other processes may bind theirs to it too
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # restart on the same port while old connections linger in TIME_WAIT
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.s.bind((host, port))
+        self.s.listen(5)
+        self.host, self.port = self.s.getsockname()
+        # lookups may also come as datagrams to the same port; without it
+        # clients simply keep to TCP
+        self.u = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            if reuse_port:
+                self.u.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.u.bind((self.host, self.port))
+        except OSError as e:
+            print("UDP lookups disabled: {}".format(e))
+            self.u.close()
+            self.u = None
+
+    def bind_unix(self, path):
+        # Listen on the Unix socket at path, replacing one left there that nobody answers on
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                if probe.connect_ex(path):
+                    os.unlink(path)
+        local = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        local.bind(path)
+        local.listen(5)
+        print("Name server listening on {}{}".format(UNIX_PREFIX, path))
+        return local
+
+    def start_workers(self, count):
+        # Fork count workers, returns True in a worker, which follows the server from its log's
+        # current position
+        position = self.log.position()
+        # what is buffered would otherwise be written by every process
+        sys.stdout.flush()
+        for worker in range(1, count + 1):
+            pid = os.fork()
+            if pid:
+                self.workers[pid] = worker
+                continue
+            self.worker = worker
+            self.workers = {}
+            self.s.close()
+            if self.u:
+                self.u.close()
+            self.bind(self.host, self.port, reuse_port=True)
+            self.primary = self.internal.getsockname()
+            self.internal.close()
+            self.internal = None
+            self.upstream = Upstream(self.primary)
+            self.parent = os.getppid()
+            # the server's log and checkpoints are its own
+            self.log = None
+            self.position = position
+            self.heard = time.time()
+            print("Worker {} serving on {}:{}".format(worker, self.host, self.port))
+            return True
+        return False
+
+    def stop_workers(self):
+        # take the workers down with the server
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers = {}
+
     def __del__(self):
         try:
             self.s.close()
+            if self.u:
+                self.u.close()
         except AttributeError:
             pass
 
     def run(self):
-        self.last_update_stale = time.time()
-        while True:
-            # Update stale users every 120 seconds
-            if time.time() - self.last_update_stale > 120.0:
-                updated = self.catalog.update_stale()
-                self.last_update_stale = time.time()
-                # Update log
-                for user_info in updated:
-                    self.log.append(*user_info)
-            # Check for new connections
-            readable, _, _ = select([self.s], [], [], 0.0)
-            if not readable:
+        # Serve requests on an asyncio event loop until interrupted; a server
+        # with workers stops them as it exits, also when terminated
+        if self.workers:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop_workers()
+            if self.local and not self.worker and os.path.exists(self.unix):
+                os.unlink(self.unix)
+
+    async def serve(self):
+        # Accept connections concurrently and sweep stale users on a timer
+        self.loop = asyncio.get_running_loop()
+        # presence pushes and relayed requests go out on one UDP socket,
+        # whose answers are matched to their requests as they arrive
+        self.udp, _ = await self.loop.create_datagram_endpoint(lambda: RelayProtocol(self), local_addr=(self.host, 0))
+        if self.u:
+            await self.loop.create_datagram_endpoint(lambda: LookupProtocol(self), sock=self.u)
+        if self.catalog.loading:
+            self.loader = self.loop.create_task(self.load_catalog())
+        if self.primary:
+            self.following = self.loop.create_task(self.follow())
+        else:
+            self.commit = GroupCommit(self.log, self.loop)
+            self.loop.call_later(REPLICA_HEARTBEAT, self.heartbeat)
+        if self.internal:
+            self.internal_server = await self.loop.create_server(lambda: NSProtocol(self, internal=True),
+                                                                 sock=self.internal)
+        self.loop.call_later(STALE_INTERVAL, self.sweep_stale)
+        if self.local:
+            self.local_server = await self.loop.create_unix_server(lambda: NSProtocol(self), sock=self.local)
+        server = await self.loop.create_server(lambda: NSProtocol(self), sock=self.s)
+        async with server:
+            await server.serve_forever()
+
+    async def load_catalog(self):
+        # Load the rest of a binary checkpoint a chunk at a time between requests; a primary
+        # tells the online users loaded its address
+        catalog = self.catalog
+        start = time.perf_counter()
+        package = str(UDPPackage('NAMESERVER', self.host, self.port, 'address update')).encode()
+        # the loaded entries live on, collections meanwhile would only traverse them over and over
+        gc.disable()
+        try:
+            while catalog.loading and catalog is self.catalog:
+                try:
+                    addresses = catalog.load()
+                except ValueError as e:
+                    self.corrupt_while_loading(e)
+                for address in addresses:
+                    if not self.primary:
+                        self.udp.sendto(package, address)
+                await asyncio.sleep(0)
+        finally:
+            gc.enable()
+        gc.freeze()
+        if catalog is self.catalog:
+            self.metrics.record('load', time.perf_counter() - start)
+            print("Loaded {} users in {:.2f}s".format(len(catalog), time.perf_counter() - start))
+
+    def corrupt_while_loading(self, error):
+        # A checkpoint block failed its checksum while loading: stop, setting the checkpoint
+        # aside if a restart can recover without it
+        error = "Checkpoint {} is unusable: {}".format(self.ckpt.path, error)
+        if self.worker:
+            print("FATAL: {}".format(error))
+        elif self.log is None:
+            print("FATAL: {}, set aside; restart to fetch the catalog from the primary again".format(error))
+            self.ckpt.set_aside()
+        else:
+            self.recover_without_checkpoint(error, serving=True)
+        raise SystemExit(1)
+
+    def sweep_stale(self):
+        # Update stale users every STALE_INTERVAL seconds, which a replica leaves to its
+        # primary; a worker whose server is gone exits
+        if self.worker and os.getppid() != self.parent:
+            os._exit(0)
+        updated = self.catalog.update_stale(mark=not self.primary)
+        # Update log; a replica gets the primary's records for these users instead
+        if self.log:
+            for user_info in updated:
+                self.append_log(*user_info)
+                self.notify(user_info[0])
+            if updated:
+                self.commit.durable(None)
+        # also compacts a log that has grown old rather than large
+        self.compact_if_due()
+        self.expire_watches()
+        self.address_limits.prune(time.time())
+        self.user_limits.prune(time.time())
+        self.loop.call_later(STALE_INTERVAL, self.sweep_stale)
+
+    def append_log(self, name, address, status, isgroup=False):
+        # log a catalog change and ship it to the followers
+        start = time.perf_counter()
+        self.log.append(name, address, status, isgroup)
+        self.metrics.record('log_append', time.perf_counter() - start)
+        if self.followers or self.joining:
+            host, port = address
+            self.replicate([self.log.seq, self.log.records, name, host, int(port), status, isgroup])
+
+    def compact_if_due(self):
+        # Start a checkpoint once the log is due for compaction, see LOG_RATIO
+        if self.log:
+            size, since = self.log.size, self.log.since
+        else:
+            size, since = self.applied, self.applied_since
+        if not size:
+            return
+        limit = min(self.max_log_bytes, max(MIN_LOG_BYTES, LOG_RATIO * self.ckpt.size))
+        if size > limit or time.time() - since > self.max_log_age:
+            self.start_checkpoint()
+
+    def start_checkpoint(self):
+        # Checkpoint in a thread or forked child, new appends go to a fresh segment
+        if self.checkpointing or self.catalog.loading or self.worker:
+            return
+        self.checkpointing = True
+        self.ckpt_ts = time.time()
+        self.ckpt_started = time.perf_counter()
+        if self.log:
+            seq, offset = self.commit.rotate(self.ckpt_ts), 0
+        else:
+            # a replica's checkpoint covers the stream up to its position
+            (seq, offset), self.applied, self.applied_since = self.position, 0, None
+        save = None
+        if self.snapshot == 'fork':
+            try:
+                save = self.fork_snapshot(seq, offset)
+            except OSError as e:
+                print("Cannot fork for a snapshot, writing it from a thread: {}".format(e))
+        if save is None:
+            snapshot = self.catalog.snapshot()
+            save = self.loop.run_in_executor(self.ckpt_executor, self.ckpt.save, snapshot, self.ckpt_ts, seq, offset)
+        save.add_done_callback(lambda f: self.checkpointed(f, seq))
+
+    def fork_snapshot(self, seq, offset):
+        # Write the checkpoint from a forked child, returns a future of its report: seconds
+        # spent, the checkpoint's size and the bytes of memory copied meanwhile
+        report, child_report = os.pipe()
+        start = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            # the child only writes the checkpoint and leaves without any of
+            # the server's cleanup; collections would only copy more pages
+            status = 1
+            try:
+                gc.disable()
+                os.close(report)
+                started = time.perf_counter()
+                size = self.ckpt.save(self.catalog.snapshot(copy=False), self.ckpt_ts, seq, offset)
+                os.write(child_report, json.dumps({'seconds': time.perf_counter() - started, 'size': size,
+                                                   'copied': private_dirty()}).encode())
+                status = 0
+            finally:
+                os._exit(status)
+        self.metrics.record('fork', time.perf_counter() - start)
+        os.close(child_report)
+        # the child is waited on in the default executor, the checkpoint thread may be busy
+        return self.loop.run_in_executor(None, reap_snapshot, pid, report)
+
+    def checkpointed(self, save, seq):
+        # the checkpoint is durable, older log segments can go
+        self.checkpointing = False
+        if save.exception() is not None:
+            print("Checkpoint failed: {}".format(save.exception()))
+            return
+        self.metrics.record('checkpoint', time.perf_counter() - self.ckpt_started)
+        if isinstance(save.result(), dict):
+            # written by a forked child, this process has not seen its size
+            report = save.result()
+            self.ckpt.size = report['size']
+            self.metrics.record('snapshot', report['seconds'])
+            if report['copied'] is not None:
+                self.metrics.set('snapshot_copied_bytes', report['copied'])
+        if self.log:
+            self.log.retire(seq)
+
+    def bloom(self, version=None):
+        # Answer a bloom request for a client's filter version [generation, count] with the
+        # names added since or the whole filter; 'unavailable' until built, not while loading
+        if self.catalog.loading:
+            return {'status': 'unavailable'}
+        bloom = self.catalog.bloom
+        if not self.bloom_building and (bloom is None or len(self.catalog) > bloom.capacity):
+            self.bloom_building = True
+            catalog = self.catalog
+            names = catalog.bloom_names()
+            build = self.loop.run_in_executor(self.ckpt_executor, build_bloom, names, 2 * len(names) + BLOOM_CHUNK)
+            build.add_done_callback(lambda f: self.bloom_built(f, catalog))
+        if bloom is None:
+            return {'status': 'unavailable'}
+        encoded_bloom, (generation, count), encoding = self.bloom_encoded
+        added = self.catalog.bloom_since(count) if encoded_bloom is bloom else None
+        if added is None or len(added) > BLOOM_DELTA:
+            # encoded once per BLOOM_DELTA names added, not for every request
+            if encoded_bloom is not bloom:
+                generation = secrets.token_hex(8)
+            snapshot = self.catalog.bloom_snapshot()
+            count, encoding, added = snapshot.count, snapshot.to_dict(), []
+            self.bloom_encoded = (bloom, (generation, count), encoding)
+        current = [generation, bloom.count]
+        if version == current:
+            return {'status': 'not modified'}
+        if isinstance(version, list) and len(version) == 2 and version[0] == generation and isinstance(version[1], int):
+            since = self.catalog.bloom_since(version[1])
+            if since is not None:
+                return {'status': 'ok', 'version': current, 'added': since}
+        return {'status': 'ok', 'version': current, 'bloom': encoding, 'added': added}
+
+    def bloom_built(self, build, catalog):
+        self.bloom_building = False
+        if build.exception() is not None:
+            print("Bloom filter failed: {}".format(build.exception()))
+            catalog.set_bloom(None)
+            return
+        catalog.set_bloom(build.result())
+
+    def handle_request(self, msg, conn=None):
+        # Decode and operate on the message, returns the response dictionary,
+        # or a future resolving to it for requests that wait on other peers
+        start = time.perf_counter()
+        try:
+            msg = json.loads(msg.decode())
+        except ValueError:
+            self.metrics.request('other', time.perf_counter() - start, 'error')
+            return {'status': 'error'}
+        res = self.dispatch(msg, conn)
+        if isinstance(res, asyncio.Future):
+            res = self.settled(res)
+        op = msg.get('op') if isinstance(msg, dict) else None
+        if not isinstance(op, str) or op not in TIMED_OPS:
+            op = 'other'
+        # the request is timed until its response is ready
+        if isinstance(res, asyncio.Future):
+            res.add_done_callback(lambda f: self.metrics.request(op, time.perf_counter() - start, f.result()['status']))
+        else:
+            self.metrics.request(op, time.perf_counter() - start, res['status'])
+        if not isinstance(msg, dict) or 'id' not in msg:
+            return res
+        # echo the request id so pipelined replies can be matched
+        if isinstance(res, asyncio.Future):
+            tagged = self.loop.create_future()
+            res.add_done_callback(lambda f: tagged.set_result({**f.result(), 'id': msg['id']}))
+            return tagged
+        return {**res, 'id': msg['id']}
+
+    def settled(self, future):
+        # a future of the response future resolves to, or of an error if it raised
+        response = self.loop.create_future()
+        def done(f):
+            if f.cancelled() or f.exception() is not None:
+                print("Request failed: {!r}".format(None if f.cancelled() else f.exception()))
+                response.set_result({'status': 'error'})
+            else:
+                response.set_result(f.result())
+        future.add_done_callback(done)
+        return response
+
+    def handle_datagram(self, data, addr):
+        # Answer a request sent over UDP, returns the reply datagram or None to drop it;
+        # other ops and replies too big for a datagram get 'tcp'
+        start = time.perf_counter()
+        try:
+            msg = json.loads(data.decode())
+            op = msg['op']
+        except (ValueError, KeyError, TypeError):
+            return None
+        if not isinstance(op, str):
+            # a list or object cannot name an op, nor be looked up among them
+            res = {'status': 'error'}
+        elif op not in DATAGRAM_OPS:
+            res = {'status': 'tcp'}
+        else:
+            # the address limit applies as to a connection, without the pause in reading
+            wait = self.address_limits.admit(addr[0], time.time())
+            res = {'status': 'retry', 'after': wait} if wait else self.dispatch(msg)
+            self.metrics.request('udp_' + op, time.perf_counter() - start, res['status'])
+        if 'id' in msg:
+            res = {**res, 'id': msg['id']}
+        reply = json.dumps(res).encode()
+        if len(reply) > MAX_DATAGRAM:
+            reply = json.dumps({'status': 'tcp', 'id': msg.get('id')}).encode()
+        return reply
+
+    def owner(self, username):
+        # address of the shard owning username, or None if it is this server
+        if not self.ring or self.ring.shard_of(username) == self.shard:
+            return None
+        return self.ring.address_of(username)
+
+    def staleness(self):
+        # seconds since a replica last heard from its primary, 0 on a primary
+        return time.time() - self.heard if self.primary else 0.0
+
+    def from_peer(self, msg):
+        # whether msg is from another shard, which knows the ring's secret
+        peer = msg.get('peer')
+        return bool(self.peer_secret) and isinstance(peer, str) and secrets.compare_digest(peer.encode(), self.peer_secret.encode())
+
+    def admit(self, msg, conn):
+        # Rate limit a request by its client's address and, for writes, by the
+        # username written; returns 0 to serve it, else seconds to retry after
+        now = time.time()
+        wait = 0
+        if conn is not None and not conn.internal and not self.from_peer(msg):
+            wait = conn.throttled = self.address_limits.admit(conn.peer, now)
+        # usernames are limited by the server for all its workers
+        if not wait and msg['op'] in ('register', 'group_info') and not self.upstream:
+            wait = self.user_limits.admit(msg['username'], now)
+        return wait
+
+    def dispatch(self, msg, conn=None):
+        # Operate on a decoded message
+        try:
+            wait = self.admit(msg, conn)
+            if wait:
+                # over the limit, turned away before touching the catalog or log
+                res = {'status': 'retry', 'after': wait}
+            elif self.upstream and msg['op'] == 'follow':
+                # replicas follow the server itself
+                res = {'status': 'moved', 'shard': list(self.primary)}
+            elif self.upstream and conn is not None and (msg['op'] not in READ_OPS
+                                                         or self.staleness() > self.max_staleness):
+                # a worker has its server answer writes, and reads while its own
+                # catalog is stale
+                res = asyncio.ensure_future(self.forward(msg))
+            elif self.primary and msg['op'] not in READ_OPS:
+                # replicas are read-only, writes go to the primary
+                res = {'status': 'readonly', 'primary': list(self.primary)}
+            elif self.primary and self.staleness() > self.max_staleness:
+                # lost touch with the primary for too long, send readers there
+                res = {'status': 'stale', 'primary': list(self.primary)}
+            elif msg['op'] in ('register', 'heartbeat', 'lookup', 'add_friend', 'group_info') and self.owner(msg['username']):
+                # the client's ring is out of date, point it at the right shard
+                res = {'status': 'moved', 'shard': list(self.owner(msg['username']))}
+            elif msg['op'] == 'ring':
+                # the shard layout, for clients to route their requests
+                if not self.ring:
+                    raise ValueError("Name server is not sharded")
+                res = {'status': 'ok', 'ring': self.ring.to_dict()}
+            elif msg['op'] == 'register':
+                # register a new user or update an existing user's information
+                isgroup = msg.get('isgroup') in (True, 'True')
+                res = {'status': 'ok'}
+                if self.catalog.add(msg['username'], msg['address'], msg['status'], isgroup=isgroup):
+                    self.notify(msg['username'])
+                    # Update log, only for changes; re-registering as is only renews the lease
+                    # the status as the catalog names it, records in one spelling parse in bulk
+                    self.append_log(msg['username'], msg['address'], str(Status.parse(msg['status'])), isgroup)
+                    if msg.get('forwarded'):
+                        # the worker answers once it has applied the record
+                        res['position'] = list(self.log.position())
+                    self.compact_if_due()
+                # reply only once the registration is durable
+                res = self.commit.durable(res)
+            elif msg['op'] == 'heartbeat':
+                # renew an online user's lease in memory, not logged; 'unknown' unless online there
+                res = {'status': 'ok' if self.catalog.refresh(msg['username'], msg['address']) else 'unknown'}
+            elif msg['op'] == 'lookup':
+                # lookup a user's information
+                user = self.catalog.lookup(msg['username'])
+                res = user.to_dict() if user else {'status': 'error'}
+            elif msg['op'] == 'bloom':
+                # a Bloom filter of the usernames this server holds, for clients to
+                # skip lookups of names never registered; 'unavailable' while it is built
+                res = self.bloom(msg.get('version'))
+            elif msg['op'] == 'lookup_many':
+                # lookup several users at once, unknown users are left out
+                users = {}
+                for name in msg['usernames']:
+                    user = self.catalog.lookup(name)
+                    if user:
+                        users[name] = user.to_dict()
+                res = {'status': 'ok', 'users': users}
+            elif msg['op'] in ('search', 'list_groups') and self.catalog.loading:
+                # the name index is complete once the catalog is loaded
+                res = {'status': 'retry', 'after': LOAD_RETRY}
+            elif msg['op'] == 'search':
+                # users whose names start with prefix, a page at a time: next is
+                # the cursor to pass as after for the following page, None at the end
+                limit = min(int(msg.get('limit') or SEARCH_LIMIT), SEARCH_MAX)
+                found, more = self.catalog.search(msg['prefix'], max(limit, 1), msg.get('after'))
+                res = {'status': 'ok', 'users': {name: user.to_dict() for name, user in found},
+                       'next': found[-1][0] if more else None}
+            elif msg['op'] == 'list_groups':
+                # public groups whose names start with prefix, paged like search,
+                # with the member count their leader last reported if any
+                limit = min(int(msg.get('limit') or SEARCH_LIMIT), SEARCH_MAX)
+                found, more = self.catalog.search(msg.get('prefix', ''), max(limit, 1), msg.get('after'), groups=True)
+                groups = {}
+                for name, group in found:
+                    groups[name] = group.to_dict()
+                    if self.catalog.members(name) is not None:
+                        groups[name]['members'] = self.catalog.members(name)
+                res = {'status': 'ok', 'groups': groups, 'next': found[-1][0] if more else None}
+            elif msg['op'] == 'group_info':
+                # a group leader reporting its member count
+                self.catalog.set_members(msg['username'], msg['members'])
+                res = {'status': 'ok'}
+            elif msg['op'] == 'add_friend':
+                res = asyncio.ensure_future(self.add_friend(msg['username'], msg['friend']))
+            elif msg['op'] == 'watch':
+                # subscribe to presence changes of usernames, pushed over UDP to
+                # address; without usernames, renew the subscriber's existing watch
+                res = self.watch(msg['username'], msg['address'], msg.get('usernames'), msg.get('token'))
+            elif msg['op'] == 'stats':
+                # counters and latency histograms for monitoring
+                res = {
+                    'status': 'ok',
+                    'uptime': time.time() - self.started,
+                    'users': len(self.catalog),
+                    'online': self.catalog.online,
+                    'loading': self.catalog.loading,
+                    'worker': self.worker,
+                    'connections': self.connections,
+                    'followers': len(self.followers),
+                    'watches': len(self.watches),
+                    'relays': len(self.relays),
+                    'rejected': {'address': self.address_limits.rejected, 'username': self.user_limits.rejected},
+                    **self.metrics.to_dict(),
+                }
+            elif msg['op'] == 'follow':
+                # a replica subscribing to the log, it is caught up once this reply is out
+                position = tuple(msg['position']) if msg['position'] else None
+                asyncio.ensure_future(self.add_follower(conn, position, tuple(msg['address'])))
+                res = {'status': 'ok'}
+            elif msg['op'] == 'replicas':
+                # the replicas currently following this server, for clients to read
+                # from; its workers already answer on its own address
+                res = {'status': 'ok', 'replicas': [list(address) for address in self.followers.values()
+                                                    if address != (self.host, self.port)]}
+            else:
+                raise ValueError("Unrecognized request")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            res = {'status': 'error'}
+        # workers answer as the server would, without a replica's staleness
+        if self.primary and not self.worker and isinstance(res, dict):
+            res['staleness'] = self.staleness()
+        return res
+
+    def watch(self, subscriber, address, usernames, token=None):
+        # Add usernames to subscriber's watch and (re)start its timeout, returns the users'
+        # information
+        host, port = address
+        address = (host, int(port))
+        if token is not None and not isinstance(token, str):
+            return {'status': 'error'}
+        watch = self.watches.get(subscriber)
+        if not watch:
+            if usernames is None:
+                # the watch has expired, the subscriber has to list its users again
+                return {'status': 'error'}
+            watch = self.watches[subscriber] = Watch(address, 0)
+        watch.address = address
+        watch.token = token
+        watch.expires = time.time() + WATCH_TIMEOUT
+        heapq.heappush(self.watch_expiry, (watch.expires, subscriber))
+        users = {}
+        for name in usernames or ():
+            watch.usernames.add(name)
+            self.watchers.setdefault(name, set()).add(subscriber)
+            user = self.catalog.lookup(name)
+            if user:
+                users[name] = user.to_dict()
+        return {'status': 'ok', 'users': users}
+
+    def expire_watches(self):
+        # drop the watches that were not renewed in time
+        now = time.time()
+        while self.watch_expiry and self.watch_expiry[0][0] < now:
+            expires, subscriber = heapq.heappop(self.watch_expiry)
+            watch = self.watches.get(subscriber)
+            if not watch or watch.expires != expires:
+                # renewed since this entry was pushed
                 continue
-            client, address = self.s.accept()
-            client.settimeout(10.0)
-            print("Connection from {}:{}".format(address[0], address[1]))
+            del self.watches[subscriber]
+            for name in watch.usernames:
+                subscribers = self.watchers[name]
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.watchers[name]
+
+    def notify(self, name):
+        # push name's new address and status to the users watching it; a lost
+        # datagram is repaired by the subscriber's next full refresh
+        subscribers = self.watchers.get(name)
+        if not subscribers:
+            return
+        package = UDPPackage('NAMESERVER', self.host, self.port, 'presence').to_dict()
+        package['content'] = {'username': name, **self.catalog.lookup(name).to_dict()}
+        for subscriber in subscribers:
+            watch = self.watches[subscriber]
+            package['token'] = watch.token
+            self.udp.sendto(json.dumps(package).encode(), watch.address)
+
+    async def forward(self, msg):
+        # Worker: have the server answer a request, a write once applied here
+        res = await self.upstream.request({**msg, 'forwarded': True})
+        position = res.pop('position', None)
+        if position and (self.position is None or tuple(position) > self.position):
+            caught_up = self.loop.create_future()
+            self.catching_up.append((tuple(position), caught_up))
             try:
-                sz = client.recv(8)
-                if not sz:
-                    # connection closed by client
-                    raise ConnectionAbortedError("Connection closed by client")
-                length = int.from_bytes(sz, "big")
-                msg = b''
-                while len(msg) < length:
-                    to_read = length - len(msg)
-                    msg += client.recv(MSG_SIZE if to_read > MSG_SIZE else to_read)
-            except:
-                client.close()
+                await asyncio.wait_for(caught_up, REPLICA_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+        return res
+
+    async def add_follower(self, conn, position, address):
+        # Catch a replica up from its log position or a snapshot, read and encoded in a
+        # thread a frame at a time, holding new records in joining; then ship it every record
+        self.joining[conn] = []
+        try:
+            caught_up = False
+            if position:
+                end = self.log.position()
+                self.log.flush()
+                caught_up = await self.send_frames(conn, self.encode_records(position, end))
+            while not caught_up and self.catalog.loading and conn.transport:
+                # a snapshot is of the whole catalog, wait until it is loaded
+                await asyncio.sleep(LOAD_RETRY)
+            if not caught_up:
+                position = list(self.log.position())
+                await self.send_frames(conn, self.encode_snapshot(self.catalog.snapshot()[1], position))
+            held = self.joining.get(conn, [])
+        finally:
+            self.joining.pop(conn, None)
+        if not conn.transport:
+            return
+        for frame in held:
+            conn.reply(frame)
+        # the stream stays open for good, it is not an idle client
+        conn.timer.cancel()
+        self.followers[conn] = address
+        print("Replica {}:{} following from {}".format(address[0], address[1], position))
+
+    async def send_frames(self, conn, frames):
+        # Send each frame as soon as the thread has encoded it, so the replica hears from
+        # us well within REPLICA_TIMEOUT; False if the frames end in None, giving up
+        done = object()
+        while conn.transport:
+            data = await self.loop.run_in_executor(None, next, frames, done)
+            if data is done:
+                break
+            if data is None:
+                return False
+            conn.send(data)
+        return True
+
+    def encode_records(self, position, end):
+        # Thread: the frames of the log records after position up to end, None
+        # if the log no longer reaches back to position
+        records = self.log.read_since(*position, end)
+        if records is None:
+            yield None
+            return
+        try:
+            for batch in iter(lambda: list(itertools.islice(records, SNAPSHOT_CHUNK)), []):
+                yield encode_frame({'op': 'records', 'records': batch})
+        except FileNotFoundError:
+            # retired by a checkpoint meanwhile
+            yield None
+
+    def encode_snapshot(self, names, position):
+        # Thread: the frames of a snapshot of the catalog's names, at position;
+        # users are looked up a frame at a time, few objects live at once
+        names = iter(names)
+        batch = list(itertools.islice(names, SNAPSHOT_CHUNK))
+        reset = True
+        while True:
+            following = list(itertools.islice(names, SNAPSHOT_CHUNK))
+            yield encode_frame({'op': 'snapshot', 'reset': reset, 'users': self.catalog.rows(batch),
+                                'position': None if following else position})
+            if not following:
+                return
+            batch, reset = following, False
+
+    def replicate(self, record):
+        # ship a log record to the followers once it is durable here
+        done = self.commit.durable(record)
+        if isinstance(done, asyncio.Future):
+            done.add_done_callback(lambda f: self.ship(f.result()))
+        else:
+            self.ship(done)
+
+    def ship(self, record):
+        # records shipped in the same loop iteration share a frame
+        if isinstance(record, dict):
+            # the log sync failed
+            return
+        if not self.shipping:
+            self.loop.call_soon(self.flush_followers)
+        self.shipping.append(record)
+
+    def flush_followers(self):
+        frame = {'op': 'records', 'records': self.shipping}
+        self.shipping = []
+        for conn in list(self.followers):
+            conn.reply(frame)
+        for held in self.joining.values():
+            held.append(frame)
+
+    def heartbeat(self):
+        # let idle followers know they are still up to date
+        if not self.shipping:
+            self.flush_followers()
+        self.loop.call_later(REPLICA_HEARTBEAT, self.heartbeat)
+
+    async def follow(self):
+        # Replica: tail the primary's log, reconnecting whenever the stream
+        # breaks; a primary's worker points the replica at the primary itself
+        source = self.primary
+        while True:
+            writer = None
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*source), CLIENT_TIMEOUT)
+                package = {'op': 'follow', 'address': [self.host, self.port],
+                           'position': list(self.position) if self.position else None}
+                message = json.dumps(package).encode()
+                writer.write(len(message).to_bytes(8, "big") + message)
+                while True:
+                    sz = await asyncio.wait_for(reader.readexactly(8), REPLICA_TIMEOUT)
+                    data = await asyncio.wait_for(reader.readexactly(int.from_bytes(sz, "big")), REPLICA_TIMEOUT)
+                    frame = json.loads(data.decode())
+                    if 'op' not in frame and frame['status'] == 'moved' and source == self.primary:
+                        source = tuple(frame['shard'])
+                        break
+                    if 'op' not in frame and frame['status'] != 'ok':
+                        raise ValueError("{}:{} is not a primary".format(*self.primary))
+                    self.apply(frame)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, KeyError) as e:
+                print("Replication from {}:{} interrupted: {!r}".format(source[0], source[1], e))
+                source = self.primary
+            finally:
+                if writer:
+                    writer.close()
+            await asyncio.sleep(REPLICA_HEARTBEAT)
+
+    def apply(self, frame):
+        # Replica: apply one frame of the replication stream
+        if frame.get('op') == 'snapshot':
+            # built aside and swapped in whole, lookups meanwhile see the old catalog
+            if frame['reset']:
+                self.incoming = Catalog()
+            for name, host, port, status, isgroup in frame['users']:
+                self.incoming.add(name, (host, port), status, verbose=False, isgroup=isgroup)
+            if frame['position']:
+                self.catalog, self.incoming = self.incoming, None
+                self.catalog.index()
+                self.position = tuple(frame['position'])
+                self.heard = time.time()
+                self.start_checkpoint()
+                self.caught_up()
+        elif frame.get('op') == 'records':
+            for seq, offset, name, host, port, status, isgroup in frame['records']:
+                # records already covered by a snapshot may still be shipped
+                if self.position and (seq, offset) <= self.position:
+                    continue
+                self.catalog.add(name, (host, port), status, verbose=False, isgroup=isgroup)
+                self.position = (seq, offset)
+                # counted as the primary's log counts them
+                self.applied += len(format_record(name, host, port, status, isgroup))
+                if self.applied_since is None:
+                    self.applied_since = time.time()
+            self.heard = time.time()
+            self.compact_if_due()
+            self.caught_up()
+
+    def caught_up(self):
+        # Worker: answer the forwarded writes this worker has now applied
+        if not self.catching_up:
+            return
+        waiting = []
+        for position, caught_up in self.catching_up:
+            if caught_up.done():
                 continue
-            # Operate on the message
+            if position <= self.position:
+                caught_up.set_result(None)
+            else:
+                waiting.append((position, caught_up))
+        self.catching_up = waiting
+
+    async def add_friend(self, from_uname, to_uname):
+        # relay from_uname's friend request to to_uname, who may live on another shard
+        sender = self.catalog.lookup(from_uname)
+        if not sender:
+            return {'status': 'error'}
+        if self.owner(to_uname):
+            package = NSPackage('lookup', to_uname).to_dict()
             try:
-                msg = json.loads(msg.decode())
-                if msg['op'] == 'register':
-                    # register a new user or update an existing user's information
-                    self.catalog.add(msg['username'], msg['address'], msg['status'])
-                    # Update log
-                    log_length = self.log.append(msg['username'], msg['address'], msg['status'])
-                    if log_length > MAX_LOGS:
-                        # Update checkpoint
-                        save_ts = time.time()
-                        self.ckpt.save(self.catalog, save_ts)
-                        self.log.truncate(save_ts)
-                    res = {'status': 'ok'}
-                elif msg['op'] == 'lookup':
-                    # lookup a user's information
-                    user = self.catalog.lookup(msg['username'])
-                    res = user if user else {'status': 'error'}
-                elif msg['op'] == 'add_friend':
-                    from_uname, to_uname = msg['username'], msg['friend']
-                    try:
-                        from_host, from_port = self.catalog.lookup(from_uname)['address']
-                        to_host, to_port = self.catalog.lookup(to_uname)['address']
-                    except TypeError:
-                        raise ValueError("User {} not found".format(from_uname))
-                    # send UDP request to to_uname about from_uname's request to add as a friend
-                    content = {'username': from_uname, 'host': from_host, 'port': from_port}
-                    res = self.send_udp('add friend', to_host, to_port, content)
-                else:
-                    raise ValueError("Unrecognized request")
-            except (ValueError, KeyError):
-                res = {'status': 'error'}
-            # Send response
-            res = json.dumps(res).encode()
-            sz = len(res).to_bytes(8, "big")
-            client.send(sz + res)
-            client.close()
-    
-    def send_udp(self, topic, to_host, to_port, content=None):
-        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_sock.settimeout(20.0)
-        from_host, from_port = '', ''
-        if topic == 'add friend':
-            from_host, from_port = udp_sock.getsockname()
-        elif topic == 'address update':
-            from_host, from_port = self.host, self.port
+                target = await self.peer_request(self.owner(to_uname), package)
+                if target.get('status') == 'moved':
+                    # the shard's ring differs from ours, ask the shard it names once
+                    target = await self.peer_request(tuple(target['shard']), package)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, KeyError, TypeError):
+                return {'status': 'error'}
+            if target.get('status') == 'retry':
+                # the shard is busy, so is this request
+                return {'status': 'retry', 'after': target.get('after', 1.0)}
+            if 'address' not in target:
+                # no such user, or the shard cannot answer
+                return {'status': 'error'}
+            to_host, to_port = target['address']
+        else:
+            target = self.catalog.lookup(to_uname)
+            if not target:
+                return {'status': 'error'}
+            to_host, to_port = target.address
+        # send UDP request to to_uname about from_uname's request to add as a friend
+        from_host, from_port = sender.address
+        content = {'username': from_uname, 'host': from_host, 'port': from_port}
+        return await self.relay('add friend', to_host, to_port, content)
+
+    async def relay(self, topic, to_host, to_port, content=None):
+        # Send a request to a user over UDP and wait for its answer, up to RELAY_TIMEOUT
+        # seconds; a host name is resolved to match the answer's address
+        try:
+            infos = await self.loop.getaddrinfo(to_host, to_port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        except OSError:
+            print("Cannot resolve user address {}:{}".format(to_host, to_port))
+            return {'status': 'error'}
+        address = infos[0][4][:2]
+        relay_id = secrets.randbits(63)
+        while relay_id in self.relays:
+            relay_id = secrets.randbits(63)
+        waiter = self.loop.create_future()
+        self.relays[relay_id] = (waiter, address)
+        from_host, from_port = self.udp.get_extra_info('sockname')[:2]
         message = {
             'senderName': 'NAMESERVER',
             'senderHost': from_host,
             'senderPort': from_port,
             'topic': topic,
+            # echoed in the answer, to match it with this request
+            'relay': relay_id,
         }
         if content:
             message['content'] = content
-        message = json.dumps(message).encode()
-        udp_sock.sendto(message, (to_host, to_port))
-        # wait for response
-        if topic == 'address update':
-            udp_sock.close()
-            return
+        self.udp.sendto(json.dumps(message).encode(), address)
         try:
-            response, _ = udp_sock.recvfrom(MSG_SIZE)
-            retry_counter  = 1
-            while not response:
-                time.sleep(2**retry_counter)
-                print("No response from user, retry in {} seconds".format(2**retry_counter))
-                response, _ = udp_sock.recvfrom(MSG_SIZE)
-                retry_counter += 1
-                if retry_counter > 5:
-                    print("No response. Please try again later.")
-                    raise socket.timeout("No response from user")
-            response = json.loads(response.decode())
-            if response['status'] == 'success':
-                res = {'status': 'success'}
-            else:
-                res = {'status': 'error'}
-        except:
-            res = {'status': 'error'}
-        udp_sock.close()
-        return res
+            response = await asyncio.wait_for(waiter, RELAY_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("No response from user at {}:{}".format(to_host, to_port))
+            return {'status': 'error'}
+        finally:
+            del self.relays[relay_id]
+        if response.get('status') == 'success':
+            return {'status': 'success'}
+        return {'status': 'error'}
 
+    def relayed(self, response, addr):
+        # A user answered a relayed request, matched by relay id or else to the oldest
+        # request sent to its address
+        addr = tuple(addr[:2])
+        relay_id = response.get('relay')
+        if relay_id is None:
+            relay_id = next((i for i, (_, to) in self.relays.items() if to == addr), None)
+        if not isinstance(relay_id, int) or relay_id not in self.relays:
+            return
+        waiter, to = self.relays[relay_id]
+        if to == addr and not waiter.done():
+            waiter.set_result(response)
+
+    async def peer_request(self, address, package):
+        # send one request to another name server and return its response
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), CLIENT_TIMEOUT)
+        try:
+            if self.peer_secret:
+                package = {**package, 'peer': self.peer_secret}
+            message = json.dumps(package).encode()
+            writer.write(len(message).to_bytes(8, "big") + message)
+            sz = await asyncio.wait_for(reader.readexactly(8), CLIENT_TIMEOUT)
+            data = await asyncio.wait_for(reader.readexactly(int.from_bytes(sz, "big")), CLIENT_TIMEOUT)
+            return json.loads(data.decode())
+        finally:
+            writer.close()
 
 
 if __name__ == '__main__':
-    ns = NameServer()
+    parser = argparse.ArgumentParser(description='P2P chat name server')
+    parser.add_argument('--host', default=None, help='address to listen on (default: this host name)')
+    parser.add_argument('--port', type=int, default=0, help='port to listen on (default: any free port)')
+    parser.add_argument('--durability', choices=DURABILITY_MODES, default=DURABILITY,
+                        help='when registrations are synced to the log before they are acknowledged')
+    parser.add_argument('--max-log-bytes', type=int, default=MAX_LOG_BYTES,
+                        help='bytes of log after which it is always compacted into a checkpoint')
+    parser.add_argument('--max-log-age', type=float, default=MAX_LOG_AGE,
+                        help='seconds after which logged records are always compacted into a checkpoint')
+    parser.add_argument('--snapshot', choices=SNAPSHOT_MODES, default=SNAPSHOT,
+                        help='whether checkpoints are written by a thread or by a forked child')
+    parser.add_argument('--ring', help='JSON file listing the shard addresses, {"shards": [[host, port], ...]}')
+    parser.add_argument('--shard', type=int, help='which shard of the ring this server is')
+    parser.add_argument('--primary', help='run as a read replica of the name server at host:port')
+    parser.add_argument('--max-staleness', type=float, default=MAX_STALENESS,
+                        help='seconds without word from the primary before a replica stops answering')
+    parser.add_argument('--address-rate', type=float, default=ADDRESS_RATE,
+                        help='requests per second admitted from one client address, 0 for no limit')
+    parser.add_argument('--user-rate', type=float, default=USER_RATE,
+                        help='registrations per second admitted for one username, 0 for no limit')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='processes answering on the port, the server and workers forwarding writes to it')
+    parser.add_argument('--unix', metavar='PATH',
+                        help='also listen on a Unix socket at PATH, for clients on this host')
+    args = parser.parse_args()
+    if args.unix and not hasattr(socket, 'AF_UNIX'):
+        parser.error("--unix needs a system with Unix sockets")
+    if args.workers > 1 and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+        parser.error("--workers needs a system with fork and SO_REUSEPORT")
+    if args.snapshot == 'fork' and not hasattr(os, 'fork'):
+        parser.error("--snapshot fork needs a system with fork")
+    ring = None
+    peer_secret = None
+    if args.ring:
+        if args.shard is None:
+            parser.error("--ring needs --shard")
+        with open(args.ring, 'r') as f:
+            ring_file = json.load(f)
+        ring = Ring.from_dict(ring_file)
+        peer_secret = ring_file.get('secret')
+        if peer_secret is not None and not isinstance(peer_secret, str):
+            parser.error("the ring's secret must be a string")
+    primary = None
+    if args.primary:
+        if ring:
+            parser.error("a replica follows one name server, --primary cannot be used with --ring")
+        try:
+            primary_host, primary_port = args.primary.rsplit(':', 1)
+            primary = (primary_host, int(primary_port))
+        except ValueError:
+            parser.error("--primary must be host:port")
+        if args.workers > 1:
+            parser.error("--workers is for a primary, start more replicas instead")
+    ns = NameServer(args.host, args.port, args.durability, args.max_log_bytes, ring, args.shard,
+                    primary, args.max_staleness, args.address_rate, args.user_rate, args.max_log_age,
+                    args.snapshot, args.workers, args.unix, peer_secret)
     ns.run()
\ No newline at end of file
@@ -0,0 +1,1326 @@
+#!/usr/bin/env python3
+'''Benchmarks for the name server.
+
+Each scenario launches a name server script in a scratch directory, so the
+same scenario can be pointed at an older NameServer.py to compare versions:
+
+    python bench-nameserver.py throughput --server NameServer.py
+    python bench-nameserver.py idle --server /tmp/old/NameServer.py
+'''
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import re
+import select
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from protocols import *
+
+MSG_SIZE = 1024
+# ops the load scenario can mix
+LOAD_OPS = ('register', 'heartbeat', 'lookup', 'add_friend')
+# seconds the load scenario waits for requests still in flight at the end of a run
+LOAD_GRACE = 5.0
+# the mixes the workers scenario offers a server at each number of workers
+WORKER_MIXES = {'lookup-heavy': 'lookup=95,register=5', 'register-heavy': 'register=80,lookup=20'}
+LISTENING = re.compile(r'Name server listening on (\S+):(\d+)')
+
+
+def unlimited_args(server, cache={}):
+    # arguments turning off a name server's rate limits, for scenarios that
+    # measure capacity from one address; older servers have no limits
+    if server not in cache:
+        usage = subprocess.run([sys.executable, os.path.abspath(server), '--help'],
+                               capture_output=True, text=True).stdout
+        cache[server] = ['--address-rate', '0', '--user-rate', '0'] if '--address-rate' in usage else []
+    return cache[server]
+
+
+class ServerProcess:
+    '''A name server running as a child process in a scratch directory.
+    Its rate limits are off unless limited is set. workdir may be a scratch
+    directory prepared beforehand, such as with a checkpoint.'''
+    def __init__(self, server, args=(), limited=False, workdir=None):
+        if not limited:
+            args = [*args, *unlimited_args(server)]
+        self.workdir = workdir or tempfile.mkdtemp(prefix='ns-bench-')
+        self.proc = subprocess.Popen(
+            [sys.executable, '-u', os.path.abspath(server), *args],
+            cwd=self.workdir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        # wait for the address line, then keep draining stdout so prints never block the server
+        for line in self.proc.stdout:
+            match = LISTENING.search(line)
+            if match:
+                self.address = (match.group(1), int(match.group(2)))
+                break
+        else:
+            raise RuntimeError("Name server exited before listening")
+        threading.Thread(target=self.proc.stdout.read, daemon=True).start()
+
+    def cpu_seconds(self):
+        # user + system CPU time consumed by the server so far (Linux only)
+        try:
+            with open('/proc/{}/stat'.format(self.proc.pid)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def request(address, package):
+    # one request on a fresh connection, as the original client does
+    message = json.dumps(package).encode()
+    with socket.create_connection(address) as conn:
+        conn.sendall(len(message).to_bytes(8, 'big') + message)
+        return json.loads(recv_frame(conn))
+
+
+class Connection:
+    '''A long-lived name server connection that tags requests with ids.'''
+    def __init__(self, address, source=None):
+        # source is the local address to connect from, to appear as another
+        # client; address may be a 'unix:' address
+        path = unix_path(address)
+        if path:
+            self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.conn.connect(path)
+        else:
+            self.conn = socket.create_connection(address, source_address=(source, 0) if source else None)
+            self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.next_id = 0
+
+    def send_many(self, packages):
+        # pipeline all requests, returns their ids
+        frames = []
+        ids = []
+        for package in packages:
+            self.next_id += 1
+            ids.append(self.next_id)
+            message = json.dumps({**package, 'id': self.next_id}).encode()
+            frames.append(len(message).to_bytes(8, 'big') + message)
+        self.conn.sendall(b''.join(frames))
+        return ids
+
+    def collect(self, ids):
+        # read the replies to ids, in the order of ids
+        responses = {}
+        while len(responses) < len(ids):
+            response = json.loads(recv_frame(self.conn))
+            responses[response.pop('id')] = response
+        return [responses[i] for i in ids]
+
+    def request_many(self, packages):
+        return self.collect(self.send_many(packages))
+
+    def request(self, package):
+        return self.request_many([package])[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def recv_frame(conn):
+    sz = b''
+    while len(sz) < 8:
+        chunk = conn.recv(8 - len(sz))
+        if not chunk:
+            raise ConnectionError("Connection closed by name server")
+        sz += chunk
+    length = int.from_bytes(sz, 'big')
+    data = b''
+    while len(data) < length:
+        chunk = conn.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by name server")
+        data += chunk
+    return data
+
+
+def bench_throughput(args):
+    # closed-loop lookups from several client threads against a single registered user
+    server = ServerProcess(args.server)
+    try:
+        request(server.address, NSPackage('register', 'bench', ('127.0.0.1', 1), 'online').to_dict())
+        package = NSPackage('lookup', 'bench').to_dict()
+        counts = [0] * args.clients
+        deadline = time.time() + args.duration
+
+        def worker(i):
+            if not args.persistent:
+                while time.time() < deadline:
+                    request(server.address, package)
+                    counts[i] += 1
+                return
+            conn = Connection(server.address)
+            while time.time() < deadline:
+                conn.request_many([package] * args.pipeline)
+                counts[i] += args.pipeline
+            conn.close()
+
+        cpu_start = server.cpu_seconds()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        cpu_end = server.cpu_seconds()
+        total = sum(counts)
+        result = {
+            'scenario': 'throughput',
+            'server': args.server,
+            'clients': args.clients,
+            'persistent': args.persistent,
+            'pipeline': args.pipeline if args.persistent else 1,
+            'requests': total,
+            'requests_per_sec': total / args.duration,
+        }
+        if cpu_start is not None and cpu_end is not None:
+            result['server_cpu_per_request_us'] = (cpu_end - cpu_start) / max(total, 1) * 1e6
+        return result
+    finally:
+        server.stop()
+
+
+def bench_datagram(args):
+    # closed-loop lookups of one registered user over each transport: a fresh
+    # connection per lookup as the original client, a persistent connection,
+    # and a datagram per lookup; latency and server CPU per lookup for each
+    server = ServerProcess(args.server)
+    try:
+        request(server.address, NSPackage('register', 'bench', ('127.0.0.1', 1), 'online').to_dict())
+        package = NSPackage('lookup', 'bench').to_dict()
+        message = json.dumps(package).encode()
+        results = []
+        for transport in ('tcp', 'persistent', 'udp'):
+            latencies = [[] for _ in range(args.clients)]
+            lost = [0] * args.clients
+            deadline = time.time() + args.duration
+
+            def worker(i):
+                if transport == 'tcp':
+                    ask = lambda: request(server.address, package)
+                elif transport == 'persistent':
+                    conn = Connection(server.address)
+                    ask = lambda: conn.request(package)
+                else:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sock.settimeout(1.0)
+                    sock.connect(server.address)
+
+                    def ask():
+                        # a lost datagram is counted and asked again, servers
+                        # without UDP lookups never answer
+                        while time.time() < deadline:
+                            sock.send(message)
+                            try:
+                                return json.loads(sock.recv(MAX_DATAGRAM))
+                            except socket.timeout:
+                                lost[i] += 1
+                while time.time() < deadline:
+                    start = time.perf_counter()
+                    response = ask()
+                    if response is None:
+                        break
+                    assert response['status'] == 'online'
+                    latencies[i].append(time.perf_counter() - start)
+                if transport == 'persistent':
+                    conn.close()
+                elif transport == 'udp':
+                    sock.close()
+
+            cpu_start = server.cpu_seconds()
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.clients)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            cpu_end = server.cpu_seconds()
+            samples = [l for per_client in latencies for l in per_client]
+            if not samples:
+                results.append({'transport': transport, 'lookups_per_sec': 0, 'lost': sum(lost)})
+                continue
+            result = {
+                'transport': transport,
+                'lookups_per_sec': len(samples) / args.duration,
+                'p50_ms': percentile(samples, 0.50) * 1e3,
+                'p99_ms': percentile(samples, 0.99) * 1e3,
+                'lost': sum(lost),
+            }
+            if cpu_start is not None and cpu_end is not None:
+                result['server_cpu_per_lookup_us'] = (cpu_end - cpu_start) / max(len(samples), 1) * 1e6
+            results.append(result)
+        return {'scenario': 'datagram', 'server': args.server, 'clients': args.clients, 'results': results}
+    finally:
+        server.stop()
+
+
+def peer_answerer(sockets, stop):
+    # answer datagrams on any of sockets as a client's handle_udp does, until stop is set
+    while not stop.is_set():
+        ready, _, _ = select.select(sockets, [], [], 0.1)
+        for sock in ready:
+            data, sender = sock.recvfrom(MSG_SIZE)
+            sock.sendto(json.dumps({'status': 'success'}).encode(), sender)
+
+
+def bench_local(args):
+    # closed-loop round trips between processes on one host, over the loopback
+    # interface and over Unix sockets: lookups on persistent name server
+    # connections to its TCP port and to its --unix socket, and peer messages
+    # sent with the client's send_udp to a peer answering over UDP only or
+    # also over its Unix socket, with latency for each
+    import Client
+    path = os.path.join(tempfile.mkdtemp(prefix='ns-bench-'), 'ns.sock')
+    server = ServerProcess(args.server, ['--unix', path])
+    try:
+        request(server.address, NSPackage('register', 'bench', ('127.0.0.1', 1), 'online').to_dict())
+        package = NSPackage('lookup', 'bench').to_dict()
+        results = []
+        for transport, address in (('tcp', server.address), ('unix', UNIX_PREFIX + path)):
+            latencies = [[] for _ in range(args.clients)]
+            deadline = time.time() + args.duration
+
+            def worker(i):
+                conn = Connection(address)
+                while time.time() < deadline:
+                    start = time.perf_counter()
+                    assert conn.request(package)['status'] == 'online'
+                    latencies[i].append(time.perf_counter() - start)
+                conn.close()
+
+            cpu_start = server.cpu_seconds()
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.clients)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            cpu_end = server.cpu_seconds()
+            samples = [l for per_client in latencies for l in per_client]
+            result = {
+                'link': 'name server',
+                'transport': transport,
+                'requests_per_sec': len(samples) / args.duration,
+                'p50_ms': percentile(samples, 0.50) * 1e3,
+                'p99_ms': percentile(samples, 0.99) * 1e3,
+            }
+            if cpu_start is not None and cpu_end is not None:
+                result['server_cpu_per_lookup_us'] = (cpu_end - cpu_start) / max(len(samples), 1) * 1e6
+            results.append(result)
+    finally:
+        server.stop()
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+    for transport in ('udp', 'unix'):
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.bind(('127.0.0.1', 0))
+        port = udp.getsockname()[1]
+        sockets = [udp]
+        if transport == 'unix':
+            sockets.append(Client.bind_local('127.0.0.1', port, 'udp', socket.SOCK_DGRAM))
+        stop = threading.Event()
+        answerer = threading.Thread(target=peer_answerer, args=(sockets, stop))
+        answerer.start()
+        samples = []
+        deadline = time.time() + args.duration
+        while time.time() < deadline:
+            start = time.perf_counter()
+            assert Client.send_udp('message', '127.0.0.1', 1, '127.0.0.1', port, 'hello', 'bench')['status'] == 'success'
+            samples.append(time.perf_counter() - start)
+        stop.set()
+        answerer.join()
+        if transport == 'unix':
+            os.unlink(Client.local_socket('127.0.0.1', port, 'udp'))
+        for sock in sockets:
+            sock.close()
+        results.append({
+            'link': 'peer',
+            'transport': transport,
+            'requests_per_sec': len(samples) / args.duration,
+            'p50_ms': percentile(samples, 0.50) * 1e3,
+            'p99_ms': percentile(samples, 0.99) * 1e3,
+        })
+    return {'scenario': 'local', 'server': args.server, 'clients': args.clients, 'results': results}
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def bench_register(args):
+    # closed-loop registrations, each client on its own persistent connection;
+    # with --preload and a small --max-log-bytes on the server this measures
+    # registration latency while checkpoints of a large catalog are written
+    server = ServerProcess(args.server, shlex.split(args.server_args))
+    try:
+        register_users(server.address, ['preload{}'.format(i) for i in range(args.preload)])
+        latencies = [[] for _ in range(args.clients)]
+        deadline = time.time() + args.duration
+
+        def worker(i):
+            conn = Connection(server.address)
+            n = 0
+            while time.time() < deadline:
+                status = 'online' if n % 2 else 'offline'
+                package = NSPackage('register', 'user{}-{}'.format(i, n % 100), ('127.0.0.1', 10000 + i), status)
+                start = time.perf_counter()
+                assert conn.request(package.to_dict())['status'] == 'ok'
+                latencies[i].append(time.perf_counter() - start)
+                n += 1
+            conn.close()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        samples = [l for per_client in latencies for l in per_client]
+        result = {
+            'scenario': 'register',
+            'server': args.server,
+            'server_args': args.server_args,
+            'clients': args.clients,
+            'preload': args.preload,
+            'registrations_per_sec': len(samples) / args.duration,
+            'p50_ms': percentile(samples, 0.50) * 1e3,
+            'p99_ms': percentile(samples, 0.99) * 1e3,
+            'max_ms': max(samples) * 1e3,
+        }
+        # the server's timings of checkpoints and of forked snapshots, if it keeps them
+        stats = request(server.address, NSPackage('stats', '').to_dict())
+        for name in ('checkpoint', 'fork', 'snapshot'):
+            if isinstance(stats.get(name), dict):
+                result['server_' + name] = {key: stats[name][key] for key in ('count', 'p50_ms', 'max_ms')}
+        if 'snapshot_copied_bytes' in stats:
+            result['server_snapshot_copied_bytes'] = stats['snapshot_copied_bytes']
+        return result
+    finally:
+        server.stop()
+
+
+def load_server_module(server):
+    # import a NameServer.py in-process, with its own protocols.py
+    sys.path.insert(0, os.path.dirname(os.path.abspath(server)))
+    spec = importlib.util.spec_from_file_location('bench_nameserver_module', server)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_memory(args):
+    # bytes per user of a Catalog holding synthetic users decoded from the wire
+    module = load_server_module(args.server)
+    hosts = ['10.0.{}.{}'.format(i // 250, i % 250) for i in range(args.hosts)]
+    tracemalloc.start()
+    catalog = module.Catalog()
+    base = tracemalloc.get_traced_memory()[0]
+    for i in range(args.users):
+        msg = json.loads(json.dumps(NSPackage(
+            'register', 'user{:07d}'.format(i), (hosts[i % len(hosts)], 10000 + i % 50000), 'online').to_dict()))
+        catalog.add(msg['username'], msg['address'], msg['status'], verbose=False)
+        del msg
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return {
+        'scenario': 'memory',
+        'server': args.server,
+        'users': args.users,
+        'hosts': args.hosts,
+        'bytes': used,
+        'bytes_per_user': used / args.users,
+    }
+
+
+def bench_search(args):
+    # prefix search over a catalog of --users synthetic names, in-process:
+    # index build time, query latency for short and long prefixes, and the
+    # cost of indexing a newly registered name; one name in a hundred is a
+    # group, listed from the group index and, for comparison, by a scan
+    module = load_server_module(args.server)
+    catalog = module.Catalog()
+    names = ['{}{:07d}'.format(['al', 'bo', 'cy', 'di', 'ed'][i % 5], i * 7919 % args.users) for i in range(args.users)]
+    for i, name in enumerate(names):
+        catalog.add(name, ('10.0.0.1', 10000), 'online', verbose=False, isgroup=i % 100 == 0)
+    start = time.perf_counter()
+    catalog.index()
+    build = time.perf_counter() - start
+    results = []
+    for prefix in ['a', 'al', 'al00', 'al00012', 'al0001234', 'zz']:
+        samples = []
+        for i in range(200):
+            start = time.perf_counter()
+            found, more = catalog.search(prefix, 20)
+            # walk to the second page as a client paging through results would
+            if more:
+                catalog.search(prefix, 20, found[-1][0])
+            samples.append(time.perf_counter() - start)
+        results.append({'prefix': prefix, 'matches_on_page': len(found),
+                        'p50_us': percentile(samples, 0.50) * 1e6, 'p99_us': percentile(samples, 0.99) * 1e6})
+    samples = []
+    for i in range(200):
+        start = time.perf_counter()
+        catalog.search('', 20, groups=True)
+        samples.append(time.perf_counter() - start)
+    groups = {'p50_us': percentile(samples, 0.50) * 1e6, 'p99_us': percentile(samples, 0.99) * 1e6}
+    start = time.perf_counter()
+    sorted(name for name, user in catalog.items() if user.isgroup)[:20]
+    groups['scan_us'] = (time.perf_counter() - start) * 1e6
+    start = time.perf_counter()
+    for i in range(10000):
+        catalog.add('new{:07d}'.format(i * 7919 % 10000), ('10.0.0.1', 10000), 'online', verbose=False)
+    insert = (time.perf_counter() - start) / 10000
+    return {
+        'scenario': 'search',
+        'server': args.server,
+        'users': args.users,
+        'index_build_sec': build,
+        'register_new_user_us': insert * 1e6,
+        'results': results,
+        'list_groups': groups,
+    }
+
+
+def bench_startup(args):
+    # restart on a checkpoint of --users synthetic users, written by the
+    # server's own Checkpoint: seconds until the server listens, answers a
+    # lookup and, for servers that load the catalog while serving, has loaded
+    # it all; and the latency of lookups meanwhile
+    module = load_server_module(args.server)
+    workdir = tempfile.mkdtemp(prefix='ns-bench-')
+    names = ['user{:07d}'.format(i) for i in range(args.users)]
+    records = ''.join('{} 10.0.{}.{} {} {}\n'.format(name, i // 250 % 40, i % 250, 10000 + i % 50000,
+                                                     'online' if i % 10 == 0 else 'offline')
+                      for i, name in enumerate(names))
+    catalog = module.Catalog()
+    catalog.restore(records)
+    catalog.index()
+    module.Checkpoint(os.path.join(workdir, module.CKPT)).save(catalog.snapshot(), time.time(), 0)
+    del records, catalog
+    checkpoint_bytes = os.path.getsize(os.path.join(workdir, module.CKPT))
+    start = time.perf_counter()
+    server = ServerProcess(args.server, shlex.split(args.server_args), workdir=workdir)
+    listening = time.perf_counter() - start
+    conn = Connection(server.address)
+    samples = []
+    first = None
+    try:
+        # lookups of random users until the server is done loading
+        while True:
+            name = random.choice(names)
+            sent = time.perf_counter()
+            response = conn.request(NSPackage('lookup', name).to_dict())
+            samples.append(time.perf_counter() - sent)
+            if first is None and response.get('address'):
+                first = time.perf_counter() - start
+            if len(samples) % 100 == 0 and not conn.request(NSPackage('stats', '').to_dict()).get('loading'):
+                break
+        loaded = time.perf_counter() - start
+    finally:
+        conn.close()
+        server.stop()
+    return {
+        'scenario': 'startup',
+        'server': args.server,
+        'users': args.users,
+        'checkpoint_bytes': checkpoint_bytes,
+        'listening_sec': listening,
+        'first_lookup_sec': first,
+        'loaded_sec': loaded,
+        'lookups': len(samples),
+        'lookup_p50_ms': percentile(samples, 0.50) * 1e3,
+        'lookup_p99_ms': percentile(samples, 0.99) * 1e3,
+        'lookup_max_ms': max(samples) * 1e3,
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def shard_worker(ring, op, duration, pipeline, worker, results):
+    # one load-generating process: pipelined batches routed through the ring
+    ring = Ring.from_dict(ring)
+    conns = [Connection(tuple(shard)) for shard in ring.shards]
+    names = ['w{}-user{}'.format(worker, i) for i in range(pipeline)]
+    by_shard = {}
+    for name in names:
+        by_shard.setdefault(ring.shard_of(name), []).append(name)
+    count = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        # every shard gets its batch before any replies are read
+        sent = []
+        for shard, shard_names in by_shard.items():
+            if op == 'register':
+                packages = [NSPackage('register', name, ('127.0.0.1', 10000 + worker), 'online').to_dict()
+                            for name in shard_names]
+            else:
+                packages = [NSPackage('lookup', name).to_dict() for name in shard_names]
+            sent.append((shard, conns[shard].send_many(packages)))
+        for shard, ids in sent:
+            conns[shard].collect(ids)
+            count += len(ids)
+    for conn in conns:
+        conn.close()
+    results.put(count)
+
+
+def bench_shards(args):
+    # aggregate throughput of N shards driven by several client processes
+    results = []
+    for n in args.shards:
+        ring = Ring([('127.0.0.1', free_port()) for _ in range(n)]).to_dict()
+        ring_path = os.path.join(tempfile.mkdtemp(prefix='ns-bench-ring-'), 'ring.json')
+        with open(ring_path, 'w') as f:
+            json.dump(ring, f)
+        servers = [ServerProcess(args.server, ['--ring', ring_path, '--shard', str(i), *shlex.split(args.server_args)])
+                   for i in range(n)]
+        try:
+            queue = multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=shard_worker,
+                                               args=(ring, args.op, args.duration, args.pipeline, i, queue))
+                       for i in range(args.clients)]
+            for w in workers:
+                w.start()
+            total = sum(queue.get() for _ in workers)
+            for w in workers:
+                w.join()
+        finally:
+            for server in servers:
+                server.stop()
+            shutil.rmtree(os.path.dirname(ring_path), ignore_errors=True)
+        results.append({'shards': n, 'requests_per_sec': total / args.duration})
+    base = results[0]['requests_per_sec'] / results[0]['shards']
+    for result in results:
+        result['scaling_efficiency'] = result['requests_per_sec'] / (base * result['shards'])
+    return {
+        'scenario': 'shards',
+        'server': args.server,
+        'op': args.op,
+        'clients': args.clients,
+        'pipeline': args.pipeline,
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+
+
+def wait_for_user(address, username, timeout=60.0):
+    # poll a name server until it knows username, returns the seconds waited
+    conn = Connection(address)
+    start = time.perf_counter()
+    try:
+        while conn.request(NSPackage('lookup', username).to_dict())['status'] in ('error', 'stale'):
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError("{} never appeared on {}:{}".format(username, *address))
+    finally:
+        conn.close()
+    return time.perf_counter() - start
+
+
+def bench_replicas(args):
+    # lookups spread over a primary and its read replicas, how long a fresh
+    # replica takes to catch up on --preload users, and replication lag
+    primary = ServerProcess(args.server, ['--host', '127.0.0.1', *shlex.split(args.server_args)])
+    replicas = []
+    try:
+        names = ['preload{}'.format(i) for i in range(args.preload)] or ['bench']
+        register_users(primary.address, names)
+        results = []
+        for n in args.replicas:
+            while len(replicas) < n:
+                start = time.perf_counter()
+                replicas.append(ServerProcess(args.server, [
+                    '--host', '127.0.0.1', '--primary', '{}:{}'.format(*primary.address)]))
+                wait_for_user(replicas[-1].address, names[-1])
+                catch_up = time.perf_counter() - start
+            readers = [replica.address for replica in replicas] or [primary.address]
+            counts = [0] * args.clients
+            deadline = time.time() + args.duration
+
+            def worker(i):
+                conn = Connection(readers[i % len(readers)])
+                packages = [NSPackage('lookup', names[(i * args.pipeline + j) % len(names)]).to_dict()
+                            for j in range(args.pipeline)]
+                while time.time() < deadline:
+                    conn.request_many(packages)
+                    counts[i] += args.pipeline
+                conn.close()
+
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.clients)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            result = {'replicas': n, 'lookups_per_sec': sum(counts) / args.duration}
+            if n:
+                result['catch_up_sec'] = catch_up
+                conn = Connection(primary.address)
+                lags = []
+                for i in range(200):
+                    name = 'lag{}-{}'.format(n, i)
+                    conn.request(NSPackage('register', name, ('127.0.0.1', 1), 'online').to_dict())
+                    lags.append(wait_for_user(replicas[-1].address, name))
+                conn.close()
+                result['lag_p50_ms'] = percentile(lags, 0.50) * 1e3
+                result['lag_p99_ms'] = percentile(lags, 0.99) * 1e3
+            results.append(result)
+        return {
+            'scenario': 'replicas',
+            'server': args.server,
+            'clients': args.clients,
+            'pipeline': args.pipeline,
+            'preload': args.preload,
+            'cpus': os.cpu_count(),
+            'results': results,
+        }
+    finally:
+        for replica in replicas:
+            replica.stop()
+        primary.stop()
+
+
+def bench_presence(args):
+    # keeping friend lists current: every client polls its friends with
+    # lookup_many each --interval seconds, or watches them once and has
+    # changes pushed; both while users change status at --churn per second
+    results = []
+    for mode in ('poll', 'watch'):
+        server = ServerProcess(args.server, shlex.split(args.server_args))
+        try:
+            friends = args.friends[0]
+            names = ['friend{}'.format(i) for i in range(args.clients * friends)]
+            register_users(server.address, names)
+            deadline = time.time() + args.duration
+            received = [0] * args.clients
+
+            def subscriber(i):
+                # the friend lists overlap, as they would between real users
+                mine = [names[(i * friends // 2 + j) % len(names)] for j in range(friends)]
+                conn = Connection(server.address)
+                udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                udp.bind(('127.0.0.1', 0))
+                udp.settimeout(0.05)
+                address = udp.getsockname()
+                if mode == 'watch':
+                    conn.request(NSPackage('watch', 'client{}'.format(i), address=address, usernames=mine).to_dict())
+                next_refresh = time.time()
+                while time.time() < deadline:
+                    if time.time() >= next_refresh:
+                        if mode == 'poll':
+                            conn.request(NSPackage('lookup_many', 'client{}'.format(i), usernames=mine).to_dict())
+                        else:
+                            # renewals ride on go_online in the client
+                            conn.request(NSPackage('watch', 'client{}'.format(i), address=address).to_dict())
+                        next_refresh += args.interval
+                    try:
+                        udp.recv(MSG_SIZE)
+                        received[i] += 1
+                    except socket.timeout:
+                        pass
+                udp.close()
+                conn.close()
+
+            def churn():
+                conn = Connection(server.address)
+                n = 0
+                while time.time() < deadline:
+                    name = names[n * 7919 % len(names)]
+                    conn.request(NSPackage('register', name, ('127.0.0.1', 10000 + n % 50000),
+                                           'offline' if n % 2 else 'online').to_dict())
+                    n += 1
+                    time.sleep(1 / args.churn)
+                conn.close()
+
+            cpu_start = server.cpu_seconds()
+            threads = [threading.Thread(target=subscriber, args=(i,)) for i in range(args.clients)]
+            threads.append(threading.Thread(target=churn))
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            cpu_end = server.cpu_seconds()
+            result = {'mode': mode, 'pushes_received': sum(received)}
+            if cpu_start is not None and cpu_end is not None:
+                result['server_cpu_percent'] = (cpu_end - cpu_start) / args.duration * 100
+            results.append(result)
+        finally:
+            server.stop()
+    return {
+        'scenario': 'presence',
+        'server': args.server,
+        'clients': args.clients,
+        'friends': args.friends[0],
+        'interval': args.interval,
+        'churn': args.churn,
+        'results': results,
+    }
+
+
+def slow_target(sock, delay, stop):
+    # a user that answers every relayed request after delay seconds
+    sock.settimeout(0.1)
+    while not stop.is_set():
+        try:
+            data, address = sock.recvfrom(MSG_SIZE)
+        except socket.timeout:
+            continue
+        except OSError:
+            # closed at the end of the run
+            return
+        relay = json.loads(data.decode()).get('relay')
+        threading.Timer(delay, sock.sendto, (json.dumps({'status': 'success', 'relay': relay}).encode(), address)).start()
+
+
+def bench_relay(args):
+    # lookup latency while --clients add_friend requests wait on targets
+    # that answer after --delay seconds, or, with --delay 0, never answer
+    server = ServerProcess(args.server, shlex.split(args.server_args))
+    stop = threading.Event()
+    targets = []
+    try:
+        request(server.address, NSPackage('register', 'asker', ('127.0.0.1', 1), 'online').to_dict())
+        for i in range(args.clients):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            targets.append(sock)
+            request(server.address, NSPackage('register', 'target{}'.format(i), sock.getsockname(), 'online').to_dict())
+            if args.delay:
+                threading.Thread(target=slow_target, args=(sock, args.delay, stop), daemon=True).start()
+
+        def lookups(seconds):
+            conn = Connection(server.address)
+            samples = []
+            deadline = time.time() + seconds
+            while time.time() < deadline:
+                start = time.perf_counter()
+                conn.request(NSPackage('lookup', 'asker').to_dict())
+                samples.append(time.perf_counter() - start)
+                time.sleep(0.01)
+            conn.close()
+            return samples
+
+        idle = lookups(1.0)
+        relays = [None] * args.clients
+
+        def add_friend(i):
+            conn = Connection(server.address)
+            conn.conn.settimeout(60)
+            start = time.perf_counter()
+            response = conn.request(NSPackage('add_friend', 'asker', friend='target{}'.format(i)).to_dict())
+            relays[i] = (time.perf_counter() - start, response['status'])
+            conn.close()
+
+        threads = [threading.Thread(target=add_friend, args=(i,)) for i in range(args.clients)]
+        for t in threads:
+            t.start()
+        busy = lookups(args.duration)
+        for t in threads:
+            t.join()
+        durations = [d for d, _ in relays]
+        return {
+            'scenario': 'relay',
+            'server': args.server,
+            'relays': args.clients,
+            'target_delay': args.delay or None,
+            'lookup_p50_ms_idle': percentile(idle, 0.50) * 1e3,
+            'lookup_p99_ms_idle': percentile(idle, 0.99) * 1e3,
+            'lookup_p50_ms_during_relays': percentile(busy, 0.50) * 1e3,
+            'lookup_p99_ms_during_relays': percentile(busy, 0.99) * 1e3,
+            'relay_p50_sec': percentile(durations, 0.50),
+            'relay_max_sec': max(durations),
+            'relays_succeeded': sum(status == 'success' for _, status in relays),
+        }
+    finally:
+        stop.set()
+        for sock in targets:
+            sock.close()
+        server.stop()
+
+
+def bench_abuse(args):
+    # latency of well-behaved clients, each on its own address, while one
+    # address floods registrations for a few usernames; with the server's
+    # rate limits off and on
+    results = []
+    for limited in (False, True):
+        server = ServerProcess(args.server, ['--host', '127.0.0.1', *shlex.split(args.server_args)], limited)
+        try:
+            deadline = time.time() + args.duration
+            latencies = [[] for _ in range(args.clients)]
+            flooded = [[0, 0] for _ in range(4)]
+
+            def client(i):
+                conn = Connection(server.address, '127.0.0.{}'.format(10 + i))
+                name = 'client{}'.format(i)
+                next_register = 0
+                while time.time() < deadline:
+                    if time.time() >= next_register:
+                        package = NSPackage('register', name, ('127.0.0.1', 10000 + i), 'online')
+                        next_register = time.time() + 1.0
+                    else:
+                        package = NSPackage('lookup', name)
+                    start = time.perf_counter()
+                    conn.request(package.to_dict())
+                    latencies[i].append(time.perf_counter() - start)
+                    time.sleep(0.01)
+                conn.close()
+
+            def abuser(i):
+                conn = Connection(server.address, '127.0.0.2')
+                packages = [NSPackage('register', 'victim{}'.format(j % 4), ('127.0.0.2', 1), 'online').to_dict()
+                            for j in range(16)]
+                while time.time() < deadline:
+                    for response in conn.request_many(packages):
+                        flooded[i][response['status'] == 'retry'] += 1
+                conn.close()
+
+            threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+            threads += [threading.Thread(target=abuser, args=(i,)) for i in range(len(flooded))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            samples = [l for per_client in latencies for l in per_client]
+            result = {
+                'limited': limited,
+                'client_p50_ms': percentile(samples, 0.50) * 1e3,
+                'client_p99_ms': percentile(samples, 0.99) * 1e3,
+                'flood_admitted_per_sec': sum(a for a, _ in flooded) / args.duration,
+                'flood_rejected_per_sec': sum(r for _, r in flooded) / args.duration,
+            }
+            results.append(result)
+        finally:
+            server.stop()
+    return {
+        'scenario': 'abuse',
+        'server': args.server,
+        'clients': args.clients,
+        'results': results,
+    }
+
+
+class LoadClient:
+    '''A simulated user for the load scenario: a persistent name server
+    connection carrying pipelined requests, and a UDP socket accepting every
+    friend request the name server relays to it.'''
+    def __init__(self, name):
+        self.name = name
+        self.next_id = 0
+        self.pending = {}
+
+    async def open(self, address):
+        loop = asyncio.get_running_loop()
+        self.udp, _ = await loop.create_datagram_endpoint(LoadAnswerer, local_addr=('127.0.0.1', 0))
+        self.address = self.udp.get_extra_info('sockname')
+        self.reader, self.writer = await asyncio.open_connection(*address)
+        self.writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.receiving = loop.create_task(self.receive())
+
+    async def receive(self):
+        # match replies to the requests waiting on them
+        try:
+            while True:
+                length = int.from_bytes(await self.reader.readexactly(8), 'big')
+                response = json.loads(await self.reader.readexactly(length))
+                waiter = self.pending.pop(response.pop('id'), None)
+                if waiter and not waiter.done():
+                    waiter.set_result(response)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            for waiter in self.pending.values():
+                if not waiter.done():
+                    waiter.set_exception(ConnectionError("Connection closed by name server"))
+
+    async def request(self, package):
+        self.next_id += 1
+        waiter = self.pending[self.next_id] = asyncio.get_running_loop().create_future()
+        message = json.dumps({**package, 'id': self.next_id}).encode()
+        self.writer.write(len(message).to_bytes(8, 'big') + message)
+        return await waiter
+
+    def close(self):
+        self.receiving.cancel()
+        self.writer.close()
+        self.udp.close()
+
+
+class LoadAnswerer(asyncio.DatagramProtocol):
+    '''Accepts the friend requests relayed to a simulated user.'''
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        relay = json.loads(data.decode()).get('relay')
+        self.transport.sendto(json.dumps({'status': 'success', 'relay': relay}).encode(), address)
+
+
+async def load_clients(address, worker, config, ready):
+    # run one load-generating process's share of the simulated users; returns
+    # {op: [latencies, {status: responses}]}
+    rng = random.Random(config['seed'] + worker)
+    ops, weights = zip(*config['mix'].items())
+    everyone = config['clients']
+    mine = range(worker, everyone, config['workers'])
+    clients = [LoadClient('load{}'.format(i)) for i in mine]
+    # the name server's listen backlog is short, connect a few clients at a time
+    connecting = asyncio.Semaphore(32)
+
+    async def start(client):
+        async with connecting:
+            await client.open(address)
+        await client.request(NSPackage('register', client.name, client.address, 'online').to_dict())
+
+    await asyncio.gather(*(start(client) for client in clients))
+    # measure once every process has registered its users
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, ready.wait)
+    results = {op: [[], {}] for op in ops}
+    in_flight = set()
+    deadline = loop.time() + config['duration']
+
+    def package(client, op):
+        other = 'load{}'.format(rng.randrange(everyone))
+        if op == 'register':
+            return NSPackage('register', client.name, client.address, 'online')
+        if op == 'heartbeat':
+            return NSPackage('heartbeat', client.name, client.address)
+        if op == 'lookup':
+            return NSPackage('lookup', other)
+        return NSPackage('add_friend', client.name, friend=other)
+
+    async def one(client, op, scheduled):
+        # latency counts from when the request was due, so a lagging
+        # generator shows up in the results rather than hiding it
+        try:
+            response = await client.request(package(client, op).to_dict())
+            status = response['status']
+            results[op][0].append(loop.time() - scheduled)
+        except ConnectionError:
+            status = 'closed'
+        results[op][1][status] = results[op][1].get(status, 0) + 1
+
+    async def closed_loop(client):
+        while loop.time() < deadline:
+            await one(client, rng.choices(ops, weights)[0], loop.time())
+            if config['think']:
+                await asyncio.sleep(rng.expovariate(1 / config['think']))
+
+    async def open_loop(client):
+        # Poisson arrivals at this client's share of the rate, whether or
+        # not earlier requests have been answered
+        rate = config['rate'] / everyone
+        due = loop.time() + rng.expovariate(rate)
+        while due < deadline:
+            await asyncio.sleep(due - loop.time())
+            task = loop.create_task(one(client, rng.choices(ops, weights)[0], due))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            due += rng.expovariate(rate)
+
+    generate = open_loop if config['rate'] else closed_loop
+    await asyncio.gather(*(generate(client) for client in clients))
+    if in_flight:
+        _, unanswered = await asyncio.wait(in_flight, timeout=LOAD_GRACE)
+        for task in unanswered:
+            task.cancel()
+        lost = len(unanswered)
+    else:
+        lost = 0
+    for client in clients:
+        client.close()
+    return results, lost
+
+
+def load_worker(address, worker, config, ready, queue):
+    # one load-generating process, thousands of simulated users need as many sockets
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+    queue.put(asyncio.run(load_clients(address, worker, config, ready)))
+
+
+def parse_mix(text):
+    # 'register=10,lookup=85,add_friend=5' as {op: weight}
+    mix = {}
+    for part in text.split(','):
+        op, _, weight = part.partition('=')
+        if op not in LOAD_OPS:
+            raise argparse.ArgumentTypeError("unknown op {}, expected one of {}".format(op, ', '.join(LOAD_OPS)))
+        try:
+            mix[op] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError("bad weight for {}: {}".format(op, weight))
+    return mix
+
+
+def server_revision(server):
+    # the git commit of the benchmarked name server, when it is in a checkout
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(server))).stdout.strip()
+    except OSError:
+        return None
+    return revision or None
+
+
+def bench_load(args):
+    # thousands of simulated users speaking the wire protocol, with a mix of
+    # ops either closed-loop (each user waits for its reply, then thinks for
+    # --think seconds) or open-loop (requests arrive at --rate per second
+    # whatever the replies do); latency per op and overall
+    server = ServerProcess(args.server, shlex.split(args.server_args))
+    try:
+        config = {
+            'clients': args.clients,
+            'workers': args.workers,
+            'mix': args.mix,
+            'rate': args.rate,
+            'think': args.think,
+            'duration': args.duration,
+            'seed': args.seed,
+        }
+        ready = multiprocessing.Barrier(args.workers + 1)
+        queue = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=load_worker, args=(server.address, i, config, ready, queue))
+                   for i in range(args.workers)]
+        for w in workers:
+            w.start()
+        ready.wait()
+        cpu_start = server.cpu_seconds()
+        results = [queue.get() for _ in workers]
+        cpu_end = server.cpu_seconds()
+        for w in workers:
+            w.join()
+        # the server's own count of log appends and fsyncs, if it keeps them
+        stats = request(server.address, NSPackage('stats', '').to_dict())
+    finally:
+        server.stop()
+    ops = {}
+    everything = []
+    for op in args.mix:
+        latencies = [l for worker_results, _ in results for l in worker_results[op][0]]
+        statuses = {}
+        for worker_results, _ in results:
+            for status, n in worker_results[op][1].items():
+                statuses[status] = statuses.get(status, 0) + n
+        everything += latencies
+        ops[op] = {
+            'requests': len(latencies),
+            'requests_per_sec': len(latencies) / args.duration,
+            'p50_ms': percentile(latencies, 0.50) * 1e3 if latencies else None,
+            'p99_ms': percentile(latencies, 0.99) * 1e3 if latencies else None,
+            'p999_ms': percentile(latencies, 0.999) * 1e3 if latencies else None,
+            'max_ms': max(latencies) * 1e3 if latencies else None,
+            'statuses': statuses,
+        }
+    result = {
+        'scenario': 'load',
+        'server': args.server,
+        'server_revision': server_revision(args.server),
+        'server_args': args.server_args,
+        'clients': args.clients,
+        'workers': args.workers,
+        'mix': args.mix,
+        'loop': 'open' if args.rate else 'closed',
+        'offered_per_sec': args.rate or None,
+        'think_sec': None if args.rate else args.think,
+        'duration': args.duration,
+        'requests': len(everything),
+        'requests_per_sec': len(everything) / args.duration,
+        'unanswered': sum(lost for _, lost in results),
+        'p50_ms': percentile(everything, 0.50) * 1e3 if everything else None,
+        'p99_ms': percentile(everything, 0.99) * 1e3 if everything else None,
+        'p999_ms': percentile(everything, 0.999) * 1e3 if everything else None,
+        'ops': ops,
+    }
+    if cpu_start is not None and cpu_end is not None:
+        result['server_cpu_per_request_us'] = (cpu_end - cpu_start) / max(len(everything), 1) * 1e6
+    for timing in ('log_append', 'fsync'):
+        if timing in stats:
+            result['server_' + timing + 's'] = stats[timing]['count']
+    return result
+
+
+def bench_workers(args):
+    # the load scenario against a server run with each of --server-workers
+    # processes, for a lookup-heavy and a register-heavy mix; workers answer
+    # lookups themselves and forward registrations to the server
+    results = []
+    for mix, weights in WORKER_MIXES.items():
+        for workers in args.server_workers:
+            run = argparse.Namespace(**{**vars(args), 'mix': parse_mix(weights),
+                                        'server_args': '{} --workers {}'.format(args.server_args, workers)})
+            result = bench_load(run)
+            results.append({
+                'mix': mix,
+                'server_workers': workers,
+                'requests_per_sec': result['requests_per_sec'],
+                'p50_ms': result['p50_ms'],
+                'p99_ms': result['p99_ms'],
+                'unanswered': result['unanswered'],
+                'ops': {op: {key: value for key, value in stats.items() if key in ('requests_per_sec', 'p50_ms', 'p99_ms')}
+                        for op, stats in result['ops'].items()},
+            })
+    return {
+        'scenario': 'workers',
+        'server': args.server,
+        'server_revision': server_revision(args.server),
+        'clients': args.clients,
+        'duration': args.duration,
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+
+
+def bench_idle(args):
+    # CPU consumed by a name server with no traffic at all
+    server = ServerProcess(args.server)
+    try:
+        time.sleep(1.0)
+        cpu_start = server.cpu_seconds()
+        time.sleep(args.duration)
+        cpu_end = server.cpu_seconds()
+        if cpu_start is None or cpu_end is None:
+            raise RuntimeError("Idle CPU measurement needs /proc")
+        return {
+            'scenario': 'idle',
+            'server': args.server,
+            'seconds': args.duration,
+            'idle_cpu_percent': (cpu_end - cpu_start) / args.duration * 100,
+        }
+    finally:
+        server.stop()
+
+
+def register_users(address, names, batch=1000):
+    # register synthetic online users quickly over one pipelined connection
+    conn = Connection(address)
+    for i in range(0, len(names), batch):
+        conn.request_many([NSPackage('register', name, ('127.0.0.1', 10000 + j % 50000), 'online').to_dict()
+                           for j, name in enumerate(names[i:i+batch], i)])
+    conn.close()
+
+
+def bench_friends(args):
+    # refresh a friend list: one lookup per friend (as before) vs one lookup_many
+    server = ServerProcess(args.server)
+    try:
+        results = []
+        for size in args.friends:
+            names = ['friend{}'.format(i) for i in range(size)]
+            register_users(server.address, names)
+            start = time.perf_counter()
+            for name in names:
+                request(server.address, NSPackage('lookup', name).to_dict())
+            sequential = time.perf_counter() - start
+            conn = Connection(server.address)
+            start = time.perf_counter()
+            conn.request_many([NSPackage('lookup', name).to_dict() for name in names])
+            pipelined = time.perf_counter() - start
+            start = time.perf_counter()
+            response = conn.request(NSPackage('lookup_many', 'bench', usernames=names).to_dict())
+            batched = time.perf_counter() - start
+            conn.close()
+            assert len(response['users']) == size
+            results.append({
+                'friends': size,
+                'sequential_ms': sequential * 1e3,
+                'pipelined_ms': pipelined * 1e3,
+                'lookup_many_ms': batched * 1e3,
+            })
+        return {'scenario': 'friends', 'server': args.server, 'results': results}
+    finally:
+        server.stop()
+
+
+SCENARIOS = {
+    'throughput': bench_throughput,
+    'datagram': bench_datagram,
+    'local': bench_local,
+    'idle': bench_idle,
+    'friends': bench_friends,
+    'register': bench_register,
+    'memory': bench_memory,
+    'startup': bench_startup,
+    'shards': bench_shards,
+    'replicas': bench_replicas,
+    'presence': bench_presence,
+    'search': bench_search,
+    'relay': bench_relay,
+    'abuse': bench_abuse,
+    'load': bench_load,
+    'workers': bench_workers,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Name server benchmarks')
+    parser.add_argument('scenario', choices=SCENARIOS)
+    parser.add_argument('--server', default=os.path.join(HERE, 'NameServer.py'),
+                        help='name server script to benchmark')
+    parser.add_argument('--server-args', default='',
+                        help='extra command line arguments for the name server')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds to measure')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='concurrent client threads, or simulated users for the load scenario')
+    parser.add_argument('--persistent', action='store_true',
+                        help='keep one connection per client instead of one per request')
+    parser.add_argument('--pipeline', type=int, default=1,
+                        help='requests in flight per persistent connection')
+    parser.add_argument('--friends', type=int, nargs='+', default=[10, 1000, 10000],
+                        help='friend list sizes for the friends scenario')
+    parser.add_argument('--preload', type=int, default=0,
+                        help='users registered before the register scenario starts measuring')
+    parser.add_argument('--users', type=int, default=1000000,
+                        help='synthetic users loaded by the memory, search and startup scenarios')
+    parser.add_argument('--hosts', type=int, default=10000,
+                        help='distinct hosts among the synthetic users')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4],
+                        help='shard counts for the shards scenario')
+    parser.add_argument('--replicas', type=int, nargs='+', default=[0, 1, 2],
+                        help='replica counts for the replicas scenario, in increasing order')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between friend list refreshes in the presence scenario')
+    parser.add_argument('--churn', type=float, default=50.0,
+                        help='status changes per second in the presence scenario')
+    parser.add_argument('--delay', type=float, default=2.0,
+                        help='seconds relay targets take to answer, 0 for targets that never do')
+    parser.add_argument('--op', choices=['lookup', 'register'], default='lookup',
+                        help='request type for the shards scenario')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('register=10,lookup=85,add_friend=5'),
+                        help='weights of the ops in the load scenario, as op=weight,...')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='requests per second offered by the load scenario, 0 for a closed loop')
+    parser.add_argument('--think', type=float, default=0.0,
+                        help='mean seconds a closed-loop simulated user waits between requests')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='load-generating processes for the load and workers scenarios')
+    parser.add_argument('--server-workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='name server processes (--workers of the server) for the workers scenario')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the load scenario')
+    args = parser.parse_args()
+    print(json.dumps(SCENARIOS[args.scenario](args)))
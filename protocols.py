@@ -1,4 +1,19 @@
+import base64
+import bisect
+import hashlib
 import json
+import struct
+
+# largest request or reply sent to the name server as a single UDP datagram,
+# below a typical path MTU so that it is never fragmented
+MAX_DATAGRAM = 1400
+# Bloom filter bits per name it is sized for, and bits set per name; a filter
+# holding as many names as it is sized for answers wrongly for about 1% of others
+BLOOM_BITS_PER_NAME = 10
+BLOOM_HASHES = 4
+# an address with this prefix names a Unix domain socket on this host,
+# 'unix:/path/to/socket', where other addresses are (host, port) pairs
+UNIX_PREFIX = 'unix:'
 
 class Base:
     '''Base class for all packages'''
@@ -26,7 +41,8 @@ class UDPPackage(Base):
 
 class NSPackage(Base):
     '''Package for NameServer'''
-    def __init__(self, op, username, address=None, status=None, friend=None, isgroup=None):
+    def __init__(self, op, username, address=None, status=None, friend=None, isgroup=None, usernames=None,
+                 prefix=None, limit=None, after=None, members=None, token=None, version=None):
         super().__init__()
         self.kwargs = {
             'op': op,
@@ -40,4 +56,100 @@ class NSPackage(Base):
         if friend:
             self.kwargs['friend'] = friend
         if isgroup:
-            self.kwargs['isgroup'] = isgroup
\ No newline at end of file
+            self.kwargs['isgroup'] = isgroup
+        if usernames is not None:
+            self.kwargs['usernames'] = usernames
+        if prefix is not None:
+            self.kwargs['prefix'] = prefix
+        if limit:
+            self.kwargs['limit'] = limit
+        if after is not None:
+            self.kwargs['after'] = after
+        if members is not None:
+            self.kwargs['members'] = members
+        if token is not None:
+            self.kwargs['token'] = token
+        if version is not None:
+            self.kwargs['version'] = version
+
+class BloomFilter:
+    '''Bloom filter of usernames, built by a name server for clients to tell
+    names it has never seen without asking. might_contain is True for every
+    name added, and for other names with a small probability.'''
+    def __init__(self, size, hashes=BLOOM_HASHES, bits=None, count=0):
+        # size in bits, a multiple of 8
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray(size // 8)
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity):
+        # an empty filter sized for capacity names
+        return cls(max(capacity, 1) * BLOOM_BITS_PER_NAME // 8 * 8 + 8)
+
+    @property
+    def capacity(self):
+        return self.size // BLOOM_BITS_PER_NAME
+
+    def positions(self, name):
+        # the bits of name: little-endian 32-bit words of its hash, modulo size
+        digest = hashlib.blake2b(name.encode(), digest_size=4 * self.hashes).digest()
+        return [word % self.size for word in struct.unpack('<{}I'.format(self.hashes), digest)]
+
+    def add(self, name):
+        for p in self.positions(name):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def might_contain(self, name):
+        return all(self.bits[p >> 3] >> (p & 7) & 1 for p in self.positions(name))
+
+    def to_dict(self):
+        return {'size': self.size, 'hashes': self.hashes, 'count': self.count,
+                'bits': base64.b64encode(self.bits).decode()}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['size'], d['hashes'], base64.b64decode(d['bits']), d['count'])
+
+def unix_path(address):
+    '''The socket path of a 'unix:' address, None for a (host, port) address'''
+    if isinstance(address, str) and address.startswith(UNIX_PREFIX):
+        return address[len(UNIX_PREFIX):]
+    return None
+
+def address_key(address):
+    '''An address as a dict key: 'unix:' addresses as they are, [host, port] as a tuple'''
+    return address if unix_path(address) else tuple(address)
+
+def ring_hash(key):
+    '''Stable 64-bit hash used to place usernames and shards on the ring'''
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+class Ring:
+    '''Consistent-hash ring assigning usernames to name server shards.
+    Shard i owns the usernames hashing closest after one of its points.'''
+    def __init__(self, shards, vnodes=64):
+        self.shards = [tuple(shard) for shard in shards]
+        self.vnodes = vnodes
+        points = sorted((ring_hash('shard{}#{}'.format(i, v)), i)
+                        for i in range(len(self.shards)) for v in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [i for _, i in points]
+
+    def shard_of(self, username):
+        # index of the shard owning username
+        i = bisect.bisect(self._hashes, ring_hash(username)) % len(self._hashes)
+        return self._owners[i]
+
+    def address_of(self, username):
+        # (host, port) of the shard owning username
+        return self.shards[self.shard_of(username)]
+
+    def to_dict(self):
+        return {'shards': [list(shard) for shard in self.shards], 'vnodes': self.vnodes}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['shards'], d.get('vnodes', 64))
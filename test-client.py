@@ -1,7 +1,9 @@
-from Client import P2PClient
+from Client import P2PClient, HEARTBEAT_INTERVAL
+from protocols import unix_path
 import select
 import socket
 import sys
+import time
 from time import strftime, localtime
 TIMEOUT = 1
 
@@ -9,30 +11,32 @@ if __name__ == "__main__":
     # Get user's information
     try:
         nameserver = sys.argv[1]
-        nshost, nsport = nameserver.split(":")
-        nsport = int(nsport)
+        # a name server on this host may be reached over its Unix socket, unix:/path
+        if not unix_path(nameserver):
+            nshost, nsport = nameserver.split(":")
+            nameserver = (nshost, int(nsport))
     except (IndexError, ValueError):
-        print("Usage: python test-client.py <nameserver_host>:<nameserver_port>")
+        print("Usage: python test-client.py <nameserver_host>:<nameserver_port> | unix:<socket_path>")
         exit(1)
     username = input("Enter your username: ")
     port = int(input("Enter your ID number (port): "))
     host = socket.gethostname()
     #print("Your host is " + host + "Your port is " + str(port) + ". Your username is " + username + ".")
     # Initialize the P2P client
-    p2p_client = P2PClient(username, host, port, nameserver=(nshost, nsport))
+    p2p_client = P2PClient(username, host, port, nameserver=nameserver)
     # Start the server
     #p2p_client.start_server()
     flag=False
     online=False
-    online_counter = 0
+    last_heartbeat = 0
     while True:
-        online_counter += 1
         if not flag:
             print("> ", end="", flush=True)
             flag=True
-        if online and online_counter % 30 == 0:
+        # renew presence by the clock, an idle pass of this loop takes seconds
+        if online and time.time() - last_heartbeat >= HEARTBEAT_INTERVAL:
             p2p_client.go_online()
-            online_counter = 1
+            last_heartbeat = time.time()
         rlist, wlist, xlist = select.select([sys.stdin], [], [], TIMEOUT)
         if rlist:
             # user has entered input
@@ -51,14 +55,17 @@ if __name__ == "__main__":
         elif command == "online":
             #p2p_client.connect_to_name_server()
             res = p2p_client.go_online()
-            p2p_client.update_friend_info()
+            # friends' status changes are pushed from now on
+            p2p_client.watch_friends()
             if res:
                 print("Successfully go online")
             else:
                 print("Failed to go online")
             online = True
+            last_heartbeat = time.time()
         elif command == "offline":
             p2p_client.go_offline()
+            online = False
         elif command and command.split()[0] == "history":
             try:
                 username = command.split()[1]
@@ -81,11 +88,39 @@ if __name__ == "__main__":
                 print("Usage: lookup <username>")
                 continue
             res = p2p_client.lookup(username)
+            if res is None:
+                print("User {} not found.".format(username))
+                continue
             print("User: ", username)
             print("Status: ", res["status"])
             last_time = strftime('%Y-%m-%d %H:%M:%S', localtime(res["last_update"]))
             print("Last updated: ", last_time)
 
+        elif command and command.split()[0] == "search":
+            try:
+                prefix = command.split()[1]
+            except IndexError:
+                print("Usage: search <prefix>")
+                continue
+            after = None
+            while True:
+                users, after = p2p_client.search(prefix, after=after)
+                for name, info in users.items():
+                    print(name + " " + info["status"])
+                if not after or input("More? (yes/no): ").lower() != "yes":
+                    break
+
+        elif command and command.split()[0] == "groups":
+            prefix = command.split()[1] if len(command.split()) > 1 else ""
+            after = None
+            while True:
+                groups, after = p2p_client.list_groups(prefix, after=after)
+                for name, info in groups.items():
+                    members = " ({} members)".format(info["members"]) if "members" in info else ""
+                    print(name + " " + info["status"] + members)
+                if not after or input("More? (yes/no): ").lower() != "yes":
+                    break
+
         elif command and command.split()[0] == "connect": #connect to friend
             try:
                 username = command.split()[1]